@@ -2,7 +2,12 @@
 Bot package initialization
 """
 
-from .bot import create_bot_application, send_email_notification
+from .bot import create_bot_application
+from .clients import BotClients, bot_clients
+from .delivery import DeliveryScheduler, delivery_scheduler, PriorityRateLimiter
+from .outbox import OutboxDispatcher, outbox_dispatcher, enqueue_calls
 from .handlers import *
 
-__all__ = ['create_bot_application', 'send_email_notification']
+__all__ = ['create_bot_application', 'BotClients', 'bot_clients',
+           'DeliveryScheduler', 'delivery_scheduler', 'PriorityRateLimiter',
+           'OutboxDispatcher', 'outbox_dispatcher', 'enqueue_calls']
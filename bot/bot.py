@@ -3,15 +3,23 @@ Telegram Bot Application
 Runs alongside FastAPI server
 """
 
+from telegram import InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto, Update
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ConversationHandler,
+    ContextTypes,
     filters
 )
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, LAZY_BODY_MODE, SUMMARY_SNIPPET_LENGTH, DOCUMENT_MIN_PARTS
+from database import AsyncSessionLocal, EmailLog, file_id_cache, attachment_store
+from bot.clients import bot_clients, interactive_request
+from bot.delivery import delivery_scheduler, PriorityRateLimiter
+from bot.digest import EXPAND_PREFIX, expand_button
+from bot.formatting import html_to_telegram, split_html, telegram_length, preview_text, MESSAGE_LIMIT
 from bot.handlers import (
     start_command,
     credits_command,
@@ -24,25 +32,61 @@ from bot.handlers import (
     handle_payment_callback,
     handle_photo,
     handle_admin_callback,
-    cancel_payment
+    cancel_payment,
+    digest_command,
+    handle_digest_callback
 )
+from contextlib import ExitStack
+from pathlib import Path
+from typing import List, Optional
+import hashlib
 import logging
+import re
+import tempfile
+import uuid
 
 logger = logging.getLogger(__name__)
 
+# Prefix of each body part when a notification is split
+PART_HEADER = "📄 <b>Part {number}</b>\n\n"
+
+# Notice under the header when the body is sent as a document
+DOCUMENT_NOTICE = "📄 <i>The full email is attached as a document.</i>"
+
+# Stands in for the EmailLog ID when a notification is rendered before its
+# log row exists (see bind_email_log); autoincrement IDs start at 1
+PENDING_LOG_ID = 0
+
+# Characters kept from the subject in a document filename
+_UNSAFE_FILENAME = re.compile(r'[^\w\- ]+')
+
+# Bot API upload limits
+PHOTO_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+MEDIA_GROUP_SIZE = 10
+MAX_CAPTION_LENGTH = 1024
+
 
 def create_bot_application():
     """
     Create and configure the Telegram bot application
     """
-    # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Create application (own connection pool; its calls take the priority lane)
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(interactive_request())
+        .rate_limiter(PriorityRateLimiter(delivery_scheduler))
+        .build()
+    )
     
     # Command handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("credits", credits_command))
     application.add_handler(CommandHandler("my_emails", my_emails_command))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("digest", digest_command))
     
     # Conversation handler for /add_email
     add_email_conv = ConversationHandler(
@@ -73,6 +117,16 @@ def create_bot_application():
         pattern="^(approve|reject)_"
     ))
     
+    application.add_handler(CallbackQueryHandler(
+        handle_digest_callback,
+        pattern="^digest_"
+    ))
+    
+    application.add_handler(CallbackQueryHandler(
+        handle_expand_callback,
+        pattern=f"^{EXPAND_PREFIX}"
+    ))
+    
     # Photo handler for payment receipts
     application.add_handler(MessageHandler(
         filters.PHOTO,
@@ -84,52 +138,51 @@ def create_bot_application():
     return application
 
 
-async def send_email_notification(telegram_id: int, email_data: dict, bot_application):
+def render_email_notification(email_data: dict, email_log_id: Optional[int] = None,
+                              document_dir: Optional[str] = None) -> List[dict]:
     """
-    Send email notification to user with attachments and full content
+    Build the Bot API calls that deliver an email notification
+    
+    Each call is a JSON-serialisable dict:
+        method: Bot method name (e.g. "send_message")
+        params: Keyword arguments other than chat_id
+        file:   Optional {"param", "path"} uploaded from disk
+    
+    With an email_log_id, emails selected by LAZY_BODY_MODE are rendered
+    as a summary with a "Show full email" button instead (the full email
+    is sent by handle_expand_callback when the button is tapped).
+    
+    With a document_dir, a body that would need DOCUMENT_MIN_PARTS or
+    more parts is written there as one .html (or .txt) file and sent as
+    a document after the header, keeping the original formatting.
     
     Args:
-        telegram_id: User's Telegram ID
         email_data: Dictionary containing email information
-        bot_application: Telegram bot application instance
+        email_log_id: EmailLog the notification belongs to
+        document_dir: Directory for body documents (owned by the caller)
     """
-    try:
-        # Escape HTML entities to prevent parse errors
-        import html
-        from io import BytesIO
-        import re
-        
-        sender = html.escape(email_data.get('from', 'Unknown'))
-        receiver = html.escape(email_data.get('to', 'Unknown'))
-        subject = html.escape(email_data.get('subject', 'No Subject'))
-        
-        # Get HTML body and convert to Telegram-compatible HTML
-        body_html = email_data.get('body_html', '')
-        body_plain = email_data.get('body_plain', 'No content')
-        
-        # Use HTML if available, otherwise plain text
-        if body_html:
-            # Simple HTML cleanup for Telegram
-            # Remove unsupported tags but keep content
-            body_content = body_html
-            # Remove script and style tags completely
-            body_content = re.sub(r'<script[^>]*>.*?</script>', '', body_content, flags=re.DOTALL | re.IGNORECASE)
-            body_content = re.sub(r'<style[^>]*>.*?</style>', '', body_content, flags=re.DOTALL | re.IGNORECASE)
-            # Convert common HTML tags to Telegram-supported ones
-            body_content = re.sub(r'<h[1-6][^>]*>(.*?)</h[1-6]>', r'<b>\1</b>\n', body_content, flags=re.DOTALL)
-            body_content = re.sub(r'<strong[^>]*>(.*?)</strong>', r'<b>\1</b>', body_content, flags=re.DOTALL)
-            body_content = re.sub(r'<em[^>]*>(.*?)</em>', r'<i>\1</i>', body_content, flags=re.DOTALL)
-            # Remove other unsupported tags but keep content
-            body_content = re.sub(r'<(?!/?(?:b|i|u|s|code|pre|a)[>\s])[^>]+>', '', body_content)
-            # Clean up extra whitespace
-            body_content = re.sub(r'\n\s*\n', '\n\n', body_content)
-            body_content = body_content.strip()
-        else:
-            # Use plain text and escape it
-            body_content = html.escape(body_plain)
-        
-        # Create header message
-        header = f"""
+    # Escape HTML entities to prevent parse errors
+    import html
+    
+    sender = html.escape(email_data.get('from', 'Unknown'))
+    receiver = html.escape(email_data.get('to', 'Unknown'))
+    subject = html.escape(email_data.get('subject', 'No Subject'))
+    
+    # Get HTML body and convert to Telegram-compatible HTML
+    body_html = email_data.get('body_html', '')
+    body_plain = email_data.get('body_plain', 'No content')
+    
+    # Use HTML if available, otherwise plain text (the parser falls back
+    # to the plain text for body_html when a message has no HTML part)
+    if body_html and body_html != body_plain:
+        # Single pass: Telegram tag subset, balanced tags, entities decoded
+        body_content = html_to_telegram(body_html)
+    else:
+        # Use plain text and escape it
+        body_content = html.escape(body_plain)
+    
+    # Create header message
+    header = f"""
 📧 <b>New Email Received!</b>
 
 <b>From:</b> <code>{sender}</code>
@@ -139,92 +192,314 @@ async def send_email_notification(telegram_id: int, email_data: dict, bot_applic
 
 ───────────────────────
 """
+
+    # Combine header and body
+    full_message = header + body_content
+    fits = telegram_length(full_message) <= MESSAGE_LIMIT
+    
+    if email_log_id is not None and (LAZY_BODY_MODE == 'always' or (LAZY_BODY_MODE == 'long' and not fits)):
+        return [render_email_summary(email_data, header, email_log_id)]
+    
+    # Split message into chunks if needed (Telegram limit is 4096 characters)
+    if fits:
+        messages = [full_message]
+    else:
+        # Send header first, then the body in parts that each parse on their own
+        part_room = MESSAGE_LIMIT - telegram_length(PART_HEADER.format(number=9999))
+        parts = split_html(body_content, part_room)
         
-        # Combine header and body
-        full_message = header + body_content
-        
-        # Telegram message limit is 4096 characters
-        MAX_LENGTH = 4096
+        # Cost model: 1 + N text messages (lossy formatting) vs header + 1 document
+        if document_dir and DOCUMENT_MIN_PARTS and len(parts) >= DOCUMENT_MIN_PARTS:
+            logger.info(
+                f"Body needs {len(parts)} parts ({telegram_length(body_content)} units) - "
+                f"sending as document (2 calls instead of {len(parts) + 1})"
+            )
+            calls = [
+                {'method': 'send_message', 'params': {'text': header + DOCUMENT_NOTICE, 'parse_mode': 'HTML'}},
+                render_body_document(email_data, document_dir),
+            ]
+            attachments = [a for a in email_data.get('attachments', [])[:10] if a.get('size')]
+            return calls + render_attachments(attachments)
         
-        # Split message into chunks if needed
-        messages = []
-        if len(full_message) <= MAX_LENGTH:
-            messages.append(full_message)
+        logger.info(f"Body needs {len(parts)} parts ({telegram_length(body_content)} units) - sending as text")
+        messages = [header]
+        for number, part in enumerate(parts, start=1):
+            messages.append(PART_HEADER.format(number=number) + part)
+    
+    calls = [
+        {'method': 'send_message', 'params': {'text': msg, 'parse_mode': 'HTML'}}
+        for msg in messages
+    ]
+    
+    # Attachments are uploaded straight from the decoded files
+    attachments = [a for a in email_data.get('attachments', [])[:10] if a.get('size')]  # Limit to 10 attachments
+    calls.extend(render_attachments(attachments))
+    
+    return calls
+
+
+def render_body_document(email_data: dict, directory: str) -> dict:
+    """
+    Write the original email body to a file and build its send_document call
+    
+    HTML bodies are kept as they are (.html), plain text as .txt. Files
+    are written with a UTF-8 BOM so browsers pick the right encoding.
+    """
+    body_html = email_data.get('body_html', '')
+    body_plain = email_data.get('body_plain', 'No content')
+    is_html = bool(body_html and body_html != body_plain)
+    content = (body_html if is_html else body_plain).encode('utf-8-sig')
+    
+    # Unique path: the outbox deletes each file once its rows are done
+    path = Path(directory) / f"{uuid.uuid4().hex}.{'html' if is_html else 'txt'}"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    
+    stem = _UNSAFE_FILENAME.sub('', email_data.get('subject') or '').strip()[:60] or "email"
+    filename = f"{stem}.{'html' if is_html else 'txt'}"
+    return {
+        'method': 'send_document',
+        'params': {'filename': filename, 'caption': f"📄 {filename}"},
+        # Same body sent to several recipients is uploaded once (file_id cache)
+        'file': {'param': 'document', 'path': str(path), 'sha256': hashlib.sha256(content).hexdigest()}
+    }
+
+
+def render_email_summary(email_data: dict, header: str, email_log_id: int) -> dict:
+    """
+    Build the compact notification: header, preview snippet and a
+    button that sends the full email (body and attachments) on demand
+    """
+    snippet = preview_text(email_data.get('body_html'), email_data.get('body_plain'), SUMMARY_SNIPPET_LENGTH)
+    return {
+        'method': 'send_message',
+        'params': {
+            'text': header + (f"<i>{snippet}</i>" if snippet else ""),
+            'parse_mode': 'HTML',
+            'reply_markup': {'inline_keyboard': [[expand_button(email_log_id, "📖 Show full email")]]},
+        }
+    }
+
+
+def bind_email_log(calls: List[dict], email_log_id: int) -> List[dict]:
+    """Point buttons of calls rendered with PENDING_LOG_ID at the stored email log"""
+    pending = expand_button(PENDING_LOG_ID, "")['callback_data']
+    bound = expand_button(email_log_id, "")['callback_data']
+    for call in calls:
+        markup = call.get('params', {}).get('reply_markup') or {}
+        for row in markup.get('inline_keyboard', []):
+            for button in row:
+                if button.get('callback_data') == pending:
+                    button['callback_data'] = bound
+    return calls
+
+
+def _attachment_kind(attachment: dict) -> str:
+    """How an attachment is sent: 'photo', 'document' or 'animation'"""
+    content_type = attachment.get('content_type', 'application/octet-stream').lower()
+    if content_type == 'image/gif':
+        return 'animation'
+    if content_type in PHOTO_TYPES and attachment['size'] <= MAX_PHOTO_BYTES:
+        return 'photo'
+    return 'document'
+
+
+def _single_upload(kind: str, attachment: dict) -> dict:
+    filename = attachment.get('filename', 'unnamed')
+    return {
+        'method': f'send_{kind}',
+        'params': {'filename': filename, 'caption': f"📎 {filename}"},
+        'file': {'param': kind, 'path': attachment['path'], 'sha256': attachment.get('sha256')}
+    }
+
+
+def render_attachments(attachments: List[dict]) -> List[dict]:
+    """
+    Build the upload calls for a list of attachments
+    
+    Photos and documents are batched into send_media_group calls (up to
+    10 items each, caption on the first item). Items a media group can't
+    carry (animations, files over the upload limit) and groups of one are
+    sent individually.
+    """
+    groups = {'photo': [], 'document': []}
+    singles = []
+    for attachment in attachments:
+        kind = _attachment_kind(attachment)
+        if kind == 'document' and attachment['size'] > MAX_UPLOAD_BYTES:
+            # Would fail the whole group; sent alone so only it fails
+            singles.append(_single_upload(kind, attachment))
+        elif kind in groups:
+            groups[kind].append(attachment)
         else:
-            # Send header first
-            messages.append(header)
+            singles.append(_single_upload(kind, attachment))
+    
+    calls = []
+    for kind, items in groups.items():
+        for start in range(0, len(items), MEDIA_GROUP_SIZE):
+            batch = items[start:start + MEDIA_GROUP_SIZE]
+            if len(batch) == 1:
+                calls.append(_single_upload(kind, batch[0]))
+                continue
             
-            # Split body into chunks
-            remaining = body_content
-            chunk_num = 1
-            while remaining:
-                # Calculate available space (leave room for chunk indicator)
-                chunk_header = f"📄 <b>Part {chunk_num}</b>\n\n"
-                available = MAX_LENGTH - len(chunk_header)
-                
-                if len(remaining) <= available:
-                    messages.append(chunk_header + remaining)
-                    break
-                
-                # Find a good break point (try to break at newline)
-                chunk = remaining[:available]
-                last_newline = chunk.rfind('\n')
-                if last_newline > available * 0.5:  # If newline is in latter half
-                    split_at = last_newline + 1
-                else:
-                    split_at = available
-                
-                messages.append(chunk_header + remaining[:split_at])
-                remaining = remaining[split_at:]
-                chunk_num += 1
-        
-        # Send all message chunks
-        for msg in messages:
-            await bot_application.bot.send_message(
-                chat_id=telegram_id,
-                text=msg,
-                parse_mode="HTML"
+            names = ", ".join(item.get('filename', 'unnamed') for item in batch)
+            media = [
+                {'type': kind, 'path': item['path'], 'filename': item.get('filename', 'unnamed'),
+                 'sha256': item.get('sha256')}
+                for item in batch
+            ]
+            media[0]['caption'] = f"📎 {names}"[:MAX_CAPTION_LENGTH]
+            calls.append({'method': 'send_media_group', 'params': {}, 'media': media})
+    
+    return calls + singles
+
+
+def call_files(call: dict) -> List[str]:
+    """Paths of the files a rendered call uploads"""
+    if call.get('file'):
+        return [call['file']['path']]
+    return [item['path'] for item in call.get('media', [])]
+
+
+def _sent_file_id(message, kind: str) -> Optional[str]:
+    """file_id of the upload in a sent message (largest size for photos)"""
+    sent = getattr(message, kind, None)
+    if kind == 'photo':
+        sent = sent[-1] if sent else None
+    return sent.file_id if sent else None
+
+
+async def execute_call(bot, chat_id: int, call: dict, priority: bool = False):
+    """
+    Perform one rendered Bot API call through the delivery scheduler
+    
+    Files uploaded before (same SHA-256) are sent by their cached
+    Telegram file_id; new uploads record theirs.
+    
+    Args:
+        bot: telegram.Bot instance
+        chat_id: Target chat
+        call: Call dict from render_email_notification
+        priority: Interactive call (ahead of bulk delivery)
+    """
+    method = getattr(bot, call['method'])
+    params = call.get('params', {})
+    file_spec = call.get('file')
+    
+    # Stored calls carry inline keyboards as Bot API JSON
+    if isinstance(params.get('reply_markup'), dict):
+        params = {**params, 'reply_markup': InlineKeyboardMarkup.de_json(params['reply_markup'], bot)}
+    
+    if call.get('media'):
+        return await _execute_media_group(bot, chat_id, call['media'], params, priority)
+    
+    if not file_spec:
+        return await delivery_scheduler.call(chat_id, lambda: method(chat_id=chat_id, **params), priority)
+    
+    kind = file_spec['param']
+    file_id = await file_id_cache.get(file_spec.get('sha256'), kind)
+    if file_id:
+        try:
+            return await delivery_scheduler.call(
+                chat_id, lambda: method(chat_id=chat_id, **{kind: file_id}, **params), priority
             )
+        except BadRequest as e:
+            logger.warning(f"Cached file_id rejected ({e}) - uploading again")
+            await file_id_cache.forget(file_spec.get('sha256'), kind)
+    
+    with open(file_spec['path'], 'rb') as file_obj:
+        def send():
+            # Rewind so a retried upload sends the whole file
+            file_obj.seek(0)
+            return method(chat_id=chat_id, **{kind: file_obj}, **params)
         
-        # Send attachments if any
-        attachments = email_data.get('attachments', [])
-        if attachments:
-            for attachment in attachments[:10]:  # Limit to 10 attachments
-                try:
-                    filename = attachment.get('filename', 'unnamed')
-                    content_type = attachment.get('content_type', 'application/octet-stream')
-                    payload = attachment.get('payload', b'')
-                    
-                    if not payload:
-                        continue
-                    
-                    # Create BytesIO object from payload
-                    file_obj = BytesIO(payload)
-                    file_obj.name = filename
-                    
-                    # Send as photo if it's an image
-                    if content_type.startswith('image/'):
-                        await bot_application.bot.send_photo(
-                            chat_id=telegram_id,
-                            photo=file_obj,
-                            caption=f"📎 {filename}"
-                        )
-                    else:
-                        # Send as document for other file types
-                        await bot_application.bot.send_document(
-                            chat_id=telegram_id,
-                            document=file_obj,
-                            caption=f"📎 {filename}"
-                        )
-                    
-                    logger.info(f"Sent attachment: {filename} to user {telegram_id}")
-                    
-                except Exception as e:
-                    logger.error(f"Failed to send attachment {filename}: {e}")
+        message = await delivery_scheduler.call(chat_id, send, priority)
+    
+    await file_id_cache.store(file_spec.get('sha256'), kind, _sent_file_id(message, kind))
+    return message
+
+
+async def _execute_media_group(bot, chat_id: int, media: List[dict], params: dict, priority: bool = False):
+    file_ids = [await file_id_cache.get(item.get('sha256'), item['type']) for item in media]
+    if any(file_ids):
+        try:
+            return await _send_media_group(bot, chat_id, media, params, file_ids, priority)
+        except BadRequest as e:
+            logger.warning(f"Cached file_id rejected ({e}) - uploading media group again")
+            for item, file_id in zip(media, file_ids):
+                if file_id:
+                    await file_id_cache.forget(item.get('sha256'), item['type'])
+    
+    return await _send_media_group(bot, chat_id, media, params, [None] * len(media), priority)
+
+
+async def _send_media_group(bot, chat_id: int, media: List[dict], params: dict, file_ids: List[Optional[str]],
+                            priority: bool = False):
+    with ExitStack() as files:
+        file_objs = [
+            file_id or files.enter_context(open(item['path'], 'rb'))
+            for item, file_id in zip(media, file_ids)
+        ]
         
-        logger.info(f"Email notification sent to user {telegram_id} ({len(messages)} message(s))")
+        def send():
+            items = []
+            for item, file_obj in zip(media, file_objs):
+                if not isinstance(file_obj, str):
+                    # Rewind so a retried upload sends the whole file
+                    file_obj.seek(0)
+                input_media = InputMediaPhoto if item['type'] == 'photo' else InputMediaDocument
+                items.append(input_media(media=file_obj, filename=item['filename'], caption=item.get('caption')))
+            return bot.send_media_group(chat_id=chat_id, media=items, **params)
         
+        messages = await delivery_scheduler.call(chat_id, send, priority)
+    
+    for item, file_id, message in zip(media, file_ids, messages):
+        if not file_id:
+            await file_id_cache.store(item.get('sha256'), item['type'], _sent_file_id(message, item['type']))
+    return messages
+
+
+async def handle_expand_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Send the full email behind a summary button (format: "expand_<email log id>")
+    
+    The email is rendered from its stored EmailLog; attachments are sent
+    from the attachment store while they are retained.
+    """
+    query = update.callback_query
+    user = update.effective_user
+    email_log_id = int(query.data[len(EXPAND_PREFIX):])
+    
+    async with AsyncSessionLocal() as session:
+        log = await session.get(EmailLog, email_log_id)
+        if not log or log.user_id != user.id:
+            await query.answer("⚠️ This email is no longer available.", show_alert=True)
+            return
+        attachments = await attachment_store.load(session, log.id)
+    
+    await query.answer()
+    
+    email_data = {
+        'from': log.sender,
+        'to': log.receiver,
+        'subject': log.subject or "No Subject",
+        'body_plain': log.body_plain or '',
+        'body_html': log.body_html,
+        'attachment_count': len(attachments),
+        'attachments': attachments,
+    }
+    try:
+        with tempfile.TemporaryDirectory() as document_dir:
+            for call in render_email_notification(email_data, document_dir=document_dir):
+                # The user is waiting: priority lane, delivery/upload pools
+                bot = bot_clients.for_call(call, context.bot)
+                await execute_call(bot, query.message.chat_id, call, priority=True)
     except Exception as e:
-        logger.error(f"Failed to send notification to {telegram_id}: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"Failed to send email {email_log_id} to {user.id}: {e}")
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text="❌ Couldn't send this email right now. Please try again later."
+        )
+        return
+    
+    logger.info(f"User {user.id} opened email {email_log_id}")
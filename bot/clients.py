@@ -0,0 +1,94 @@
+"""
+Telegram HTTP Clients
+Separate connection pools for interactive replies, email delivery and
+media uploads, so a delivery burst can't exhaust the connections that
+command replies need
+"""
+
+from typing import Optional
+import logging
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from config import (
+    TELEGRAM_BOT_TOKEN, TELEGRAM_HTTP_VERSION,
+    TELEGRAM_INTERACTIVE_POOL_SIZE, TELEGRAM_INTERACTIVE_TIMEOUT,
+    TELEGRAM_DELIVERY_POOL_SIZE, TELEGRAM_DELIVERY_TIMEOUT,
+    TELEGRAM_UPLOAD_POOL_SIZE, TELEGRAM_UPLOAD_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+def build_request(pool_size: int, timeout: float, upload_timeout: Optional[float] = None) -> HTTPXRequest:
+    """
+    HTTPXRequest with its own connection pool
+    
+    Args:
+        pool_size: Maximum concurrent connections
+        timeout: Connect/read/write timeout in seconds
+        upload_timeout: Write timeout for file uploads (defaults to timeout)
+    """
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=timeout,
+        read_timeout=timeout,
+        write_timeout=timeout,
+        media_write_timeout=upload_timeout or timeout,
+        # Waiting for a free connection counts against the caller, not Telegram
+        pool_timeout=timeout,
+        http_version=TELEGRAM_HTTP_VERSION,
+    )
+
+
+def interactive_request() -> HTTPXRequest:
+    """Pool for the bot application (command replies, callbacks, admin actions)"""
+    return build_request(TELEGRAM_INTERACTIVE_POOL_SIZE, TELEGRAM_INTERACTIVE_TIMEOUT)
+
+
+class BotClients:
+    """
+    Bot instances for background delivery, each with its own pool
+    
+    delivery sends text messages; upload sends documents, photos and
+    media groups with a long write timeout. Both share the bot token
+    with the application's interactive bot.
+    """
+    
+    def __init__(self, token: str):
+        self.token = token
+        self.delivery: Optional[Bot] = None
+        self.upload: Optional[Bot] = None
+    
+    @property
+    def running(self) -> bool:
+        return self.delivery is not None
+    
+    async def start(self):
+        self.delivery = Bot(self.token, request=build_request(TELEGRAM_DELIVERY_POOL_SIZE, TELEGRAM_DELIVERY_TIMEOUT))
+        self.upload = Bot(
+            self.token,
+            request=build_request(TELEGRAM_UPLOAD_POOL_SIZE, TELEGRAM_DELIVERY_TIMEOUT, TELEGRAM_UPLOAD_TIMEOUT)
+        )
+        await self.delivery.initialize()
+        await self.upload.initialize()
+        logger.info("✅ Telegram delivery clients started")
+    
+    async def stop(self):
+        for bot in (self.delivery, self.upload):
+            if bot:
+                await bot.shutdown()
+        self.delivery = self.upload = None
+    
+    def for_call(self, call: dict, fallback: Bot) -> Bot:
+        """Client for a rendered call (fallback until the clients are started)"""
+        if not self.running:
+            return fallback
+        if call.get('file') or call.get('media'):
+            return self.upload
+        return self.delivery
+
+
+# Process-wide delivery clients
+bot_clients = BotClients(TELEGRAM_BOT_TOKEN)
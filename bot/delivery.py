@@ -0,0 +1,227 @@
+"""
+Telegram Delivery Scheduler
+Paces outbound Bot API calls with a global token bucket plus per-chat
+token buckets, keeps calls FIFO within each chat and honours RetryAfter.
+Interactive calls (command replies, on-demand emails) take a priority
+lane ahead of bulk email delivery.
+"""
+
+from collections import deque
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, Tuple
+import asyncio
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_MAX_RETRY_AFTER
+)
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate` tokens per second"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._priority_waiting = 0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def pause(self, seconds: float):
+        """Drain the bucket so the next token is available in `seconds`"""
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+    
+    async def acquire(self, priority: bool = False):
+        """
+        Wait for a token
+        
+        Regular waiters are served in FIFO order; priority waiters skip
+        the queue and regular waiters hold back while any are waiting.
+        """
+        if priority:
+            self._priority_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+            finally:
+                self._priority_waiting -= 1
+        
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and not self._priority_waiting:
+                    self.tokens -= 1
+                    return
+                # Tokens left for priority waiters: check again after one refill
+                await asyncio.sleep((1 - self.tokens if self.tokens < 1 else 1) / self.rate)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Seconds Telegram asked us to wait (int or timedelta depending on PTB settings)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class DeliveryScheduler:
+    """
+    Central scheduler for outbound Telegram API calls
+    
+    Each chat has a FIFO queue drained by its own short-lived task, so
+    one slow or rate-limited chat never holds up the others. Every call
+    takes a token from the chat's bucket and then the global bucket.
+    A RetryAfter pauses that chat for the requested time and retries the
+    same call, so nothing is dropped or reordered.
+    
+    Priority calls are queued ahead of the chat's regular calls and take
+    global tokens before any regular call.
+    """
+    
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1,
+                 chat_burst: float = 3, max_retries: int = 5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queues: Dict[int, Deque[Tuple[Callable[[], Awaitable], asyncio.Future, bool]]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._in_flight = 0
+    
+    async def call(self, chat_id: int, factory: Callable[[], Awaitable], priority: bool = False):
+        """
+        Schedule an API call for a chat and wait for its result
+        
+        Args:
+            chat_id: Target chat (used for ordering and per-chat limits)
+            factory: Zero-argument callable returning the API coroutine;
+                     it is called again for each retry
+            priority: Interactive call - goes ahead of regular calls
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(chat_id, deque())
+        if priority:
+            # After earlier priority calls, before the chat's bulk backlog
+            position = next((i for i, entry in enumerate(queue) if not entry[2]), len(queue))
+            queue.insert(position, (factory, future, priority))
+        else:
+            queue.append((factory, future, priority))
+        
+        if chat_id not in self._tasks:
+            self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id))
+        
+        return await future
+    
+    @property
+    def depth(self) -> int:
+        """Number of calls waiting or in flight across all chats"""
+        return sum(len(queue) for queue in self._queues.values()) + self._in_flight
+    
+    async def _drain(self, chat_id: int):
+        queue = self._queues[chat_id]
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        
+        try:
+            while queue:
+                factory, future, priority = queue.popleft()
+                self._in_flight += 1
+                try:
+                    result = await self._execute(chat_id, bucket, factory, priority)
+                except asyncio.CancelledError:
+                    future.cancel()
+                    raise
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    self._in_flight -= 1
+        finally:
+            del self._tasks[chat_id]
+            if not queue:
+                self._queues.pop(chat_id, None)
+            for _, future, _ in queue:
+                future.cancel()
+    
+    async def _execute(self, chat_id: int, bucket: TokenBucket, factory: Callable[[], Awaitable],
+                       priority: bool = False):
+        attempt = 0
+        while True:
+            await bucket.acquire()
+            await self.global_bucket.acquire(priority)
+            try:
+                return await factory()
+            except RetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = retry_after_seconds(e)
+                logger.warning(
+                    f"Telegram flood control for chat {chat_id}: retrying in {delay:.0f}s "
+                    f"(attempt {attempt}/{self.max_retries}, queue depth {self.depth})"
+                )
+                bucket.pause(delay)
+    
+    async def stop(self):
+        """Cancel all pending deliveries"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """
+    Rate limiter for the bot application's own calls (command replies,
+    admin actions): message-producing requests take a priority token from
+    the scheduler's global bucket, so bulk delivery can't starve them
+    """
+    
+    # Bot API methods that count towards Telegram's global message limit
+    LIMITED_PREFIXES = ('send', 'copy', 'forward', 'edit')
+    
+    def __init__(self, scheduler: "DeliveryScheduler"):
+        self.scheduler = scheduler
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def process_request(self, callback, args: Any, kwargs: Dict[str, Any], endpoint: str,
+                              data: Dict[str, Any], rate_limit_args: Any):
+        if endpoint.startswith(self.LIMITED_PREFIXES):
+            await self.scheduler.global_bucket.acquire(priority=True)
+        return await callback(*args, **kwargs)
+
+
+# Process-wide scheduler used for all email deliveries
+delivery_scheduler = DeliveryScheduler(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    chat_burst=TELEGRAM_CHAT_BURST,
+    max_retries=TELEGRAM_MAX_RETRY_AFTER,
+)
@@ -0,0 +1,152 @@
+"""
+Email Digests
+Aliases in digest mode collect their emails for a configurable window and
+deliver them as one summary message, with a button per email that sends
+the full email on demand
+"""
+
+from typing import List
+import html
+
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import DIGEST_PAGE_SIZE, DIGEST_SNIPPET_LENGTH
+from database import DigestEntry, EmailLog, EmailAttachment
+from bot.formatting import preview_text
+
+# Outbox method name of a scheduled digest (handled by the dispatcher, not the Bot API)
+DIGEST_METHOD = 'send_digest'
+
+# Callback data prefix of the per-email buttons
+EXPAND_PREFIX = 'expand_'
+
+SUBJECT_LENGTH = 100
+SENDER_LENGTH = 80
+
+
+def digest_call(alias: str) -> dict:
+    """Outbox call that delivers the waiting digest of an alias"""
+    return {'method': DIGEST_METHOD, 'params': {'alias': alias}}
+
+
+def expand_button(email_log_id: int, label: str) -> dict:
+    """Inline button (Bot API JSON) that sends the full email"""
+    return {'text': label, 'callback_data': f"{EXPAND_PREFIX}{email_log_id}"}
+
+
+async def add_to_digest(session: AsyncSession, chat_id: int, alias: str, email_log_id: int) -> bool:
+    """
+    Add an email to the next digest of an alias within the caller's transaction
+    
+    Returns True when no digest was waiting for the alias yet, i.e. the
+    caller has to schedule one (digest_call) at the end of the window.
+    """
+    waiting = await session.scalar(
+        select(DigestEntry.id)
+        .where(DigestEntry.chat_id == chat_id)
+        .where(DigestEntry.alias == alias)
+        .where(DigestEntry.outbox_id.is_(None))
+        .limit(1)
+    )
+    session.add(DigestEntry(chat_id=chat_id, alias=alias, email_log_id=email_log_id))
+    return waiting is None
+
+
+async def claim_digest(session: AsyncSession, outbox_id: int, chat_id: int, alias: str) -> list:
+    """
+    Assign the waiting entries of an alias to a digest and load them
+    
+    Idempotent: a retried digest sends the entries it claimed before,
+    plus any that arrived since.
+    
+    Returns:
+        Rows of (email_log_id, sender, subject, body_html, body_plain, attachment count)
+    """
+    await session.execute(
+        update(DigestEntry)
+        .where(DigestEntry.chat_id == chat_id)
+        .where(DigestEntry.alias == alias)
+        .where(DigestEntry.outbox_id.is_(None))
+        .values(outbox_id=outbox_id)
+    )
+    
+    attachments = (
+        select(func.count(EmailAttachment.id))
+        .where(EmailAttachment.email_log_id == EmailLog.id)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        select(EmailLog.id, EmailLog.sender, EmailLog.subject, EmailLog.body_html,
+               EmailLog.body_plain, attachments)
+        .join(DigestEntry, DigestEntry.email_log_id == EmailLog.id)
+        .where(DigestEntry.outbox_id == outbox_id)
+        .order_by(DigestEntry.id)
+    )
+    return result.all()
+
+
+async def release_digest(session: AsyncSession, outbox_id: int, chat_id: int, alias: str) -> bool:
+    """
+    Drop the entries of a delivered digest within the caller's transaction
+    
+    Returns True if entries are waiting that no digest has been scheduled
+    for (an email that arrived while this digest was being claimed).
+    """
+    await session.execute(delete(DigestEntry).where(DigestEntry.outbox_id == outbox_id))
+    waiting = await session.scalar(
+        select(DigestEntry.id)
+        .where(DigestEntry.chat_id == chat_id)
+        .where(DigestEntry.alias == alias)
+        .where(DigestEntry.outbox_id.is_(None))
+        .limit(1)
+    )
+    return waiting is not None
+
+
+def _shorten(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:length - 1] + '…'
+
+
+def render_digest(alias: str, entries: list) -> List[dict]:
+    """
+    Build the summary messages of a digest
+    
+    Each message lists up to DIGEST_PAGE_SIZE emails (sender, subject and
+    a preview snippet) with a numbered button per email.
+    """
+    pages = [entries[start:start + DIGEST_PAGE_SIZE] for start in range(0, len(entries), DIGEST_PAGE_SIZE)]
+    
+    calls = []
+    for page_number, page in enumerate(pages, start=1):
+        title = f"🗞 <b>Digest</b> for <code>{html.escape(alias)}</code>: {len(entries)} new email(s)"
+        if len(pages) > 1:
+            title += f" ({page_number}/{len(pages)})"
+        
+        lines = [title, ""]
+        buttons = []
+        for number, (email_log_id, sender, subject, body_html, body_plain, attachment_count) in enumerate(
+                page, start=(page_number - 1) * DIGEST_PAGE_SIZE + 1):
+            lines.append(f"<b>{number}. {html.escape(_shorten(subject or 'No Subject', SUBJECT_LENGTH))}</b>")
+            details = f"From: <code>{html.escape(_shorten(sender, SENDER_LENGTH))}</code>"
+            if attachment_count:
+                details += f" · 📎 {attachment_count}"
+            lines.append(details)
+            snippet = preview_text(body_html, body_plain, DIGEST_SNIPPET_LENGTH)
+            if snippet:
+                lines.append(f"<i>{snippet}</i>")
+            lines.append("")
+            buttons.append(expand_button(email_log_id, f"📖 {number}"))
+        
+        # Five buttons per keyboard row
+        keyboard = [buttons[start:start + 5] for start in range(0, len(buttons), 5)]
+        calls.append({
+            'method': 'send_message',
+            'params': {
+                'text': "\n".join(lines).strip(),
+                'parse_mode': 'HTML',
+                'reply_markup': {'inline_keyboard': keyboard},
+            }
+        })
+    
+    return calls
@@ -0,0 +1,494 @@
+"""
+Telegram HTML Formatting
+Converts email HTML into the subset of HTML accepted by Telegram's
+parse_mode=HTML in a single linear pass
+"""
+
+from html import escape, unescape
+from typing import Dict, List, NamedTuple, Optional
+import re
+
+# Email tags mapped to the Telegram tag they become
+INLINE_TAGS = {
+    'b': 'b', 'strong': 'b',
+    'i': 'i', 'em': 'i', 'cite': 'i',
+    'u': 'u', 'ins': 'u',
+    's': 's', 'strike': 's', 'del': 's',
+    'code': 'code', 'kbd': 'code', 'samp': 'code', 'tt': 'code',
+    'pre': 'pre',
+    'a': 'a',
+    'blockquote': 'blockquote',
+    'h1': 'b', 'h2': 'b', 'h3': 'b', 'h4': 'b', 'h5': 'b', 'h6': 'b',
+}
+
+# Tags whose content is never shown
+SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template', 'svg', 'object'}
+
+# Tags that start a new paragraph (blank line) or a new line
+PARAGRAPH_TAGS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'ul', 'ol',
+                  'blockquote', 'pre', 'hr', 'section', 'article', 'header', 'footer'}
+LINE_TAGS = {'div', 'tr', 'li', 'dt', 'dd', 'address', 'center', 'form', 'fieldset'}
+CELL_TAGS = {'td', 'th'}
+
+# Telegram rejects entities nested inside these
+NO_NESTING = {'code', 'pre'}
+
+LINK_SCHEMES = ('http://', 'https://', 'mailto:', 'tg://')
+
+
+class _TagAction(NamedTuple):
+    """What a start or end tag does, worked out once per tag name"""
+    newlines: int           # line breaks around it: 2 for a paragraph, 1 for a line
+    target: Optional[str]   # Telegram tag it becomes
+    special: Optional[str]  # 'br', 'cell', 'list' or 'item'
+
+
+def _tag_action(tag: str) -> _TagAction:
+    newlines = 2 if tag in PARAGRAPH_TAGS else 1 if tag in LINE_TAGS else 0
+    if tag == 'br':
+        special = 'br'
+    elif tag in CELL_TAGS:
+        special = 'cell'
+    elif tag in ('ul', 'ol'):
+        special = 'list'
+    elif tag == 'li':
+        special = 'item'
+    else:
+        special = None
+    return _TagAction(newlines, INLINE_TAGS.get(tag), special)
+
+
+# Only these tags have handlers; every other tag is dropped by the tokenizer loop
+# without a method call (most newsletter tags: span, img, font, tbody, ...)
+_TAG_ACTIONS = {
+    tag: _tag_action(tag)
+    for tag in [*INLINE_TAGS, *PARAGRAPH_TAGS, *LINE_TAGS, *CELL_TAGS, 'br']
+}
+
+# One token per match: comment, doctype/processing instruction, tag, text or a bare '<'.
+# The attribute run is unambiguous (unquoted text stops at '<', '>' or a quote; quoted
+# values are bounded), so a '<' that never closes fails after a short scan and is kept
+# as a literal '&lt;' instead of rescanning the rest of the document. Whitespace after
+# a tag belongs to the tag's token, since indentation between tags is most of the text
+# tokens in email markup. The runs are possessive: giving characters back never helps
+# them match.
+_TOKEN = re.compile(
+    r'<!--.*?(?:-->|\Z)'
+    r'|<[!?][^>]*+>?'
+    r'|<(/?)([a-zA-Z][a-zA-Z0-9:-]*+)'
+    r'([^<>"\']*+(?:(?:"[^"]{0,8192}+"|\'[^\']{0,8192}+\')[^<>"\']*+)*+)>(\s*+)'
+    r'|([^<]++)'
+    r'|<',
+    re.DOTALL
+)
+_HREF = re.compile(r'''(?:^|\s)href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+_SKIP_END = {tag: re.compile(rf'</{tag}\s*>', re.IGNORECASE) for tag in SKIPPED_TAGS}
+
+
+def _escape_text(text: str) -> str:
+    """html.escape(text, quote=False) without the call overhead for plain text"""
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+class TelegramHTMLConverter:
+    """
+    Single-pass HTML-to-Telegram converter
+    
+    A small tokenizer walks the input once (text, tags, comments);
+    tags outside the Telegram set are dropped with their text kept,
+    block tags become line breaks, entities are decoded and text is
+    re-escaped. Every emitted tag is balanced: misnested end tags close
+    and reopen the tags above them, and anything still open at the end
+    is closed. A tag that is already open is not opened again, so the
+    open-tag stack stays a handful of entries deep.
+    """
+    
+    def __init__(self):
+        self.out: List[str] = []
+        self.stack: List[str] = []            # open Telegram tags
+        self.open_tags: List[str] = []        # their opening markup
+        self.suppressed: Dict[str, int] = {}  # nested opens that were not emitted
+        self.list_counters: List[Optional[int]] = []
+        self.unclosed = set()                 # skipped tags with no end tag left in the document
+        self.newlines = 0                     # line breaks waiting to be written
+        self.space = False                    # a collapsed space is waiting
+        self.after_space = True               # output so far ends with whitespace
+        self.at_start = True
+    
+    def convert(self, html: str) -> str:
+        """Convert a complete HTML document"""
+        pos = 0
+        while pos is not None:
+            pos = self._consume(html, pos)
+        
+        while self.stack:
+            self._close_top()
+        return ''.join(self.out).strip()
+    
+    def _consume(self, html: str, pos: int) -> Optional[int]:
+        """Tokenize from pos; returns where to resume after a skipped element, or None at the end"""
+        handle_data = self.handle_data
+        for match in _TOKEN.finditer(html, pos):
+            closing, tag, attrs, trailing, text = match.groups()
+            if text is not None:
+                handle_data(text)
+                continue
+            if tag is None:
+                # Comments, doctypes and conditional comments produce no output;
+                # a bare '<' is text
+                if match.end() - match.start() == 1:
+                    handle_data('<')
+                continue
+            
+            tag = tag.lower()
+            if tag in _TAG_ACTIONS:
+                if closing:
+                    self.handle_endtag(tag)
+                else:
+                    self.handle_starttag(tag, attrs)
+            elif tag in SKIPPED_TAGS and not closing and not attrs.endswith('/'):
+                # Jump straight past the element's content; without an end tag
+                # only the opening tag is dropped
+                if tag not in self.unclosed:
+                    skip = _SKIP_END[tag].search(html, match.start(4))
+                    if skip is not None:
+                        return skip.end()
+                    self.unclosed.add(tag)
+            
+            if trailing:
+                if self.stack and self.stack[-1] == 'pre':
+                    self._text(trailing)
+                else:
+                    # Indentation between tags collapses to at most one space
+                    self.space = self.space or not self.at_start
+        return None
+    
+    # Output helpers
+    
+    def _break(self, count: int):
+        if not self.at_start and self.newlines < count:
+            self.newlines = count
+        self.space = False
+    
+    def _flush(self):
+        if self.newlines:
+            self.out.append('\n' * self.newlines)
+            self.newlines = 0
+            self.after_space = True
+        elif self.space and not self.after_space:
+            self.out.append(' ')
+            self.after_space = True
+        self.space = False
+    
+    def _text(self, text: str):
+        # _flush inlined: this runs once per text token
+        if self.newlines:
+            self.out.append('\n' * self.newlines)
+            self.newlines = 0
+        elif self.space and not self.after_space:
+            self.out.append(' ')
+        self.space = False
+        self.out.append(text)
+        self.at_start = False
+        self.after_space = text[-1].isspace()
+    
+    def _open(self, tag: str, markup: str):
+        self._flush()
+        self.out.append(markup)
+        self.stack.append(tag)
+        self.open_tags.append(markup)
+    
+    def _close_top(self):
+        tag = self.stack.pop()
+        markup = self.open_tags.pop()
+        if self.out and self.out[-1] is markup:
+            # Drop empty pairs such as <b></b>
+            self.out.pop()
+        else:
+            self.out.append(f'</{tag}>')
+    
+    # Token handlers
+    
+    def handle_starttag(self, tag: str, attrs: str):
+        newlines, target, special = _TAG_ACTIONS[tag]
+        if newlines:
+            self._break(newlines)
+        if special is None:
+            pass
+        elif special == 'br':
+            self.newlines = min(self.newlines + 1, 2)
+            self.space = False
+            return
+        elif special == 'cell':
+            self.space = not self.at_start
+        elif special == 'list':
+            self.list_counters.append(0 if tag == 'ol' else None)
+        else:
+            counter = self.list_counters[-1] if self.list_counters else None
+            if counter is None:
+                self._text('• ')
+            else:
+                self.list_counters[-1] = counter + 1
+                self._text(f'{counter + 1}. ')
+        
+        if not target:
+            return
+        
+        markup = None
+        if target in self.stack or (self.stack and self.stack[-1] in NO_NESTING):
+            pass
+        elif target == 'a':
+            href = _HREF.search(attrs)
+            href = unescape(next(filter(None, href.groups()), '')).strip() if href else ''
+            if href.lower().startswith(LINK_SCHEMES):
+                markup = f'<a href="{escape(href)}">'
+        else:
+            markup = f'<{target}>'
+        
+        if markup:
+            self._open(target, markup)
+        else:
+            # Remember the skipped open so its end tag doesn't close the outer one
+            self.suppressed[target] = self.suppressed.get(target, 0) + 1
+    
+    def handle_endtag(self, tag: str):
+        newlines, target, special = _TAG_ACTIONS[tag]
+        if not target:
+            pass
+        elif self.suppressed.get(target):
+            self.suppressed[target] -= 1
+        elif target in self.stack:
+            # Close everything above the matching tag, then reopen it
+            reopen = []
+            while self.stack[-1] != target:
+                reopen.append((self.stack[-1], self.open_tags[-1]))
+                self._close_top()
+            self._close_top()
+            for open_tag, markup in reversed(reopen):
+                self._open(open_tag, markup)
+        
+        if special == 'list' and self.list_counters:
+            self.list_counters.pop()
+        if newlines:
+            self._break(newlines)
+    
+    def handle_data(self, data: str):
+        if '&' in data:
+            data = unescape(data)
+        
+        if self.stack and self.stack[-1] == 'pre':
+            # Preformatted text keeps its whitespace
+            self._text(_escape_text(data))
+            return
+        
+        words = data.split()
+        if not words:
+            # Indentation between tags collapses to at most one space
+            self.space = self.space or not self.at_start
+            return
+        
+        if not self.at_start and data[0].isspace():
+            self.space = True
+        self._text(_escape_text(' '.join(words)))
+        self.space = data[-1].isspace()
+
+
+def html_to_telegram(html: str) -> str:
+    """
+    Convert email HTML to Telegram-compatible HTML in one pass
+    
+    Args:
+        html: Email HTML body
+    
+    Returns:
+        Balanced HTML using only tags Telegram accepts
+    """
+    return TelegramHTMLConverter().convert(html)
+
+
+# Only the start of a long HTML body is converted for a preview
+_PREVIEW_SCAN = 64 * 1024
+_ANY_TAG = re.compile(r'<[^>]*>')
+
+
+def preview_text(body_html: Optional[str], body_plain: Optional[str], length: int = 120) -> str:
+    """
+    Short one-line preview of an email body, escaped for Telegram HTML
+    
+    Args:
+        body_html: Email HTML body (the plain text when there is no HTML part)
+        body_plain: Email plain text body
+        length: Maximum preview length in characters
+    """
+    # Same choice as the full notification: HTML unless it is just the plain text
+    if body_html and body_html != body_plain:
+        text = unescape(_ANY_TAG.sub(' ', html_to_telegram(body_html[:_PREVIEW_SCAN])))
+    elif body_plain:
+        text = body_plain[:_PREVIEW_SCAN]
+    else:
+        return ''
+    
+    text = _WHITESPACE.sub(' ', text).strip()
+    if len(text) > length:
+        text = text[:length - 1].rstrip() + '…'
+    return escape(text, quote=False)
+
+
+# Telegram's limit for one message, in UTF-16 code units
+MESSAGE_LIMIT = 4096
+
+# Split points, best first
+_PARAGRAPH, _LINE, _WORD, _TOKEN_EDGE = range(4)
+
+# Text runs are capped at one message, so a run without breaks (CJK, base64)
+# is never rescanned or re-encoded in full for every chunk cut from it
+_SPLIT_TOKEN = re.compile(rf'<[^>]*>|&#?[a-zA-Z0-9]+;|\n\n+|\n| +|[^<&\n ]{{1,{MESSAGE_LIMIT}}}|[<&]')
+_TAG_NAME = re.compile(r'</?([a-zA-Z][a-zA-Z0-9-]*)')
+
+
+def telegram_length(text: str) -> int:
+    """Length as Telegram counts it (UTF-16 code units)"""
+    return len(text) if text.isascii() else len(text.encode('utf-16-le')) // 2
+
+
+def _truncate_units(text: str, units: int) -> str:
+    """Longest prefix of text that fits in units"""
+    if text.isascii():
+        return text[:units]
+    # A surrogate pair cut in half is dropped by the decoder
+    return text.encode('utf-16-le')[:units * 2].decode('utf-16-le', errors='ignore')
+
+
+class _Break(NamedTuple):
+    end: int         # chunk ends here
+    resume: int      # next chunk starts here (whitespace at the split is dropped)
+    stack: tuple     # tags open at the split
+    used: int        # units in the chunk up to end, including reopened tags
+    has_text: bool
+
+
+class _HTMLSplitter:
+    """
+    Splits Telegram HTML into chunks in one forward walk
+    
+    Tags and entities are never cut. Tags open at a split are closed at
+    the end of the chunk and reopened at the start of the next one, and
+    the room needed for those closing tags is reserved as the walk goes,
+    so every chunk fits the limit.
+    """
+    
+    def __init__(self, text: str, limit: int):
+        self.text = text
+        self.limit = limit
+        self.chunks: List[str] = []
+        self._start_chunk(0, ())
+    
+    def _start_chunk(self, pos: int, stack: tuple):
+        self.start = pos
+        self.reopen = ''.join(markup for _, markup in stack)
+        self.stack = stack                  # (name, markup) pairs open at the walk position
+        self.close_units = sum(len(name) + 3 for name, _ in stack)
+        self.used = telegram_length(self.reopen)
+        self.has_text = False
+        self.breaks: List[Optional[_Break]] = [None] * 4
+    
+    def _emit(self, end: int, stack: tuple, has_text: bool):
+        if has_text:
+            closing = ''.join(f'</{name}>' for name, _ in reversed(stack))
+            self.chunks.append(self.reopen + self.text[self.start:end] + closing)
+    
+    def _best_break(self) -> Optional[_Break]:
+        # Prefer the best kind of split that still fills at least half the chunk
+        half = self.limit // 2
+        for candidate in self.breaks:
+            if candidate and candidate.used >= half:
+                return candidate
+        return max(filter(None, self.breaks), key=lambda candidate: candidate.used, default=None)
+    
+    def split(self) -> List[str]:
+        text = self.text
+        pos = 0
+        while pos < len(text):
+            token = _SPLIT_TOKEN.match(text, pos).group()
+            end = pos + len(token)
+            first = token[0]
+            
+            if pos > self.start:
+                if first == '\n':
+                    kind = _PARAGRAPH if len(token) > 1 else _LINE
+                elif first == ' ':
+                    kind = _WORD
+                else:
+                    kind = _TOKEN_EDGE
+                resume = end if kind != _TOKEN_EDGE else pos
+                self.breaks[kind] = _Break(pos, resume, self.stack, self.used, self.has_text)
+            
+            # Work out the tag stack and closing-tag room after this token
+            stack = self.stack
+            close_units = self.close_units
+            if first == '<' and len(token) > 1:
+                name = _TAG_NAME.match(token)
+                name = name.group(1).lower() if name else None
+                if token[1] == '/':
+                    if stack and stack[-1][0] == name:
+                        stack = stack[:-1]
+                        close_units -= len(name) + 3
+                elif name:
+                    stack = stack + ((name, token),)
+                    close_units += len(name) + 3
+            units = telegram_length(token)
+            
+            if self.used + units + close_units <= self.limit:
+                self.used += units
+                self.stack = stack
+                self.close_units = close_units
+                self.has_text = self.has_text or first not in ' \n<'
+                pos = end
+                continue
+            
+            split = self._best_break()
+            if split:
+                self._emit(split.end, split.stack, split.has_text)
+                self._start_chunk(split.resume, split.stack)
+                pos = split.resume
+                continue
+            
+            # Nothing to split on since the chunk started: cut inside a text run
+            room = self.limit - self.used - self.close_units
+            piece = _truncate_units(token, room) if first not in '<&' else ''
+            if piece:
+                self.has_text = True
+                self._emit(pos + len(piece), self.stack, True)
+                self._start_chunk(pos + len(piece), self.stack)
+                pos += len(piece)
+            else:
+                # A tag or entity too long for an empty chunk is dropped
+                pos = end
+        
+        self._emit(len(text), self.stack, self.has_text)
+        return self.chunks
+
+
+def split_html(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    Split Telegram HTML into chunks of at most limit UTF-16 units
+    
+    Splits on paragraph, line and word boundaries in that order of
+    preference, never inside a tag or entity; formatting open at a
+    split is closed and reopened so each chunk parses on its own.
+    
+    Args:
+        text: Balanced Telegram HTML (e.g. from html_to_telegram)
+        limit: Maximum chunk length
+    
+    Returns:
+        Chunks in order
+    """
+    return _HTMLSplitter(text, limit).split()
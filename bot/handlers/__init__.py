@@ -11,6 +11,7 @@ from .help import help_command
 from .payment import handle_payment_callback, handle_photo
 from .admin import handle_admin_callback
 from .cancel import cancel_payment
+from .digest import digest_command, handle_digest_callback
 
 __all__ = [
     'start_command',
@@ -24,6 +25,8 @@ __all__ = [
     'handle_payment_callback',
     'handle_photo',
     'handle_admin_callback',
-    'cancel_payment'
+    'cancel_payment',
+    'digest_command',
+    'handle_digest_callback'
 ]
 
@@ -5,8 +5,8 @@ Create new email aliases with validation and database integration
 
 from telegram import Update
 from telegram.ext import ContextTypes, ConversationHandler
-from sqlalchemy import select
-from database import AsyncSessionLocal, User, Domain, UserEmail
+from sqlalchemy import select, update as sql_update
+from database import AsyncSessionLocal, User, Domain, UserEmail, routing_cache, address_filter
 from datetime import datetime
 import logging
 import re
@@ -232,8 +232,16 @@ async def handle_email_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return ConversationHandler.END
         
-        # Double-check credits
-        if db_user.credits <= 0:
+        # Deduct credit; the conditional update can't overdraw concurrent requests
+        remaining_credits = await session.scalar(
+            sql_update(User)
+            .where(User.telegram_id == db_user.telegram_id)
+            .where(User.credits > 0)
+            .values(credits=User.credits - 1)
+            .returning(User.credits)
+        )
+        if remaining_credits is None:
+            await session.rollback()
             await update.message.reply_text(
                 "❌ <b>Insufficient Credits</b>\n\n"
                 "You don't have any credits left.",
@@ -249,18 +257,19 @@ async def handle_email_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         session.add(new_email)
         
-        # Deduct credit
-        db_user.credits -= 1
-        
         await session.commit()
         
+        # Drop any cached "unknown address" entry so mail routes immediately
+        routing_cache.invalidate(email_input)
+        address_filter.add(email_input, new_email.id)
+        
         # Success message
         success_message = f"""
 ✅ <b>Email Created Successfully!</b>
 
 📧 <b>Your new email:</b> <code>{email_input}</code>
 🌐 <b>Domain:</b> {domain_part}
-💳 <b>Remaining Credits:</b> {db_user.credits}
+💳 <b>Remaining Credits:</b> {remaining_credits}
 
 🎉 <b>You're all set!</b>
 
@@ -270,7 +279,7 @@ Use /my_emails to see all your email addresses.
         """
         
         await update.message.reply_text(success_message, parse_mode="HTML")
-        logger.info(f"User {user.id} created email: {email_input} (Credits left: {db_user.credits})")
+        logger.info(f"User {user.id} created email: {email_input} (Credits left: {remaining_credits})")
         
         # Clear context
         context.user_data.clear()
@@ -5,13 +5,41 @@ Handle payment approval/rejection
 
 from telegram import Update
 from telegram.ext import ContextTypes
-from sqlalchemy import select
+from sqlalchemy import select, update as sql_update
 from database import AsyncSessionLocal, User, Transaction, TransactionStatus
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+async def _claim_review(session, transaction_id: int, status: TransactionStatus) -> bool:
+    """
+    Move a pending transaction to status within the caller's transaction
+    
+    The status check and the change are one conditional UPDATE, so of two
+    admins reviewing the same payment at once only the first succeeds.
+    """
+    claimed = await session.scalar(
+        sql_update(Transaction)
+        .where(Transaction.id == transaction_id)
+        .where(Transaction.status == TransactionStatus.PENDING)
+        .values(status=status)
+        .returning(Transaction.id)
+    )
+    return claimed is not None
+
+
+async def _show_already_processed(query, session, transaction):
+    """Roll back a lost review and show the status the other review set"""
+    await session.rollback()
+    await session.refresh(transaction)
+    status_emoji = "✅" if transaction.status == TransactionStatus.APPROVED else "❌"
+    await query.edit_message_caption(
+        caption=query.message.caption + f"\n\n{status_emoji} Already processed: {transaction.status.value}",
+        parse_mode="HTML"
+    )
+
+
 async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Handle admin approval/rejection callbacks
@@ -49,13 +77,9 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
             logger.warning(f"Transaction {transaction_id} not found")
             return
         
-        # Check if already processed
+        # Check if already processed (re-checked atomically when the review is recorded)
         if transaction.status != TransactionStatus.PENDING:
-            status_emoji = "✅" if transaction.status == TransactionStatus.APPROVED else "❌"
-            await query.edit_message_caption(
-                caption=query.message.caption + f"\n\n{status_emoji} Already processed: {transaction.status.value}",
-                parse_mode="HTML"
-            )
+            await _show_already_processed(query, session, transaction)
             return
         
         # Fetch user
@@ -84,12 +108,19 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
                 )
                 return
             
-            # Add credits
-            credits_to_add = plan_info['credits']
-            user.credits += credits_to_add
+            # Record the approval first; credits are added only if this review won
+            if not await _claim_review(session, transaction_id, TransactionStatus.APPROVED):
+                await _show_already_processed(query, session, transaction)
+                return
             
-            # Update transaction status
-            transaction.status = TransactionStatus.APPROVED
+            # Add credits in the database, not from the balance read above
+            credits_to_add = plan_info['credits']
+            new_balance = await session.scalar(
+                sql_update(User)
+                .where(User.telegram_id == user.telegram_id)
+                .values(credits=User.credits + credits_to_add)
+                .returning(User.credits)
+            )
             
             await session.commit()
             
@@ -98,7 +129,7 @@ async def handle_admin_callback(update: Update, context: ContextTypes.DEFAULT_TY
                 "⏳ Pending Review",
                 f"✅ Approved by @{admin_user.username or admin_user.first_name}"
             )
-            updated_caption += f"\n\n<b>Credits Added:</b> {credits_to_add}\n<b>New Balance:</b> {user.credits}"
+            updated_caption += f"\n\n<b>Credits Added:</b> {credits_to_add}\n<b>New Balance:</b> {new_balance}"
             
             await query.edit_message_caption(
                 caption=updated_caption,
@@ -116,7 +147,7 @@ Your payment has been approved by our admin team.
 
 <b>Plan:</b> {plan_info['name']}
 <b>Credits Added:</b> {credits_to_add}
-<b>New Balance:</b> {user.credits} credit(s)
+<b>New Balance:</b> {new_balance} credit(s)
 
 🎉 You can now create email addresses using /add_email
 
@@ -130,7 +161,9 @@ Thank you for your purchase! 🙏
         
         elif action == "reject":
             # Reject payment
-            transaction.status = TransactionStatus.REJECTED
+            if not await _claim_review(session, transaction_id, TransactionStatus.REJECTED):
+                await _show_already_processed(query, session, transaction)
+                return
             
             await session.commit()
             
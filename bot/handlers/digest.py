@@ -0,0 +1,117 @@
+"""
+/digest command handler
+Switch email addresses between instant delivery and digest mode
+"""
+
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import ContextTypes
+from sqlalchemy import select
+from database import AsyncSessionLocal, UserEmail, routing_cache
+from config import DIGEST_WINDOWS
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _window_label(minutes: int) -> str:
+    if minutes == 0:
+        return "Instant"
+    if minutes % 60 == 0:
+        return f"{minutes // 60}h"
+    return f"{minutes}m"
+
+
+def build_digest_menu(user_emails):
+    """
+    Build the /digest message and keyboard for a user's addresses
+    """
+    message = "🗞 <b>Digest Mode</b>\n\n"
+    message += "Busy address? Emails arriving within the chosen window are bundled into one summary "
+    message += "message, with a button to open each email.\n\n"
+    
+    keyboard = []
+    for email in user_emails:
+        current = email.digest_window // 60
+        message += f"<code>{email.email_address}</code>: <b>{_window_label(current)}</b>\n"
+        
+        row = []
+        for minutes in [0] + DIGEST_WINDOWS:
+            label = _window_label(minutes)
+            if minutes == current:
+                label = f"✅ {label}"
+            row.append(InlineKeyboardButton(label, callback_data=f"digest_{email.id}_{minutes}"))
+        keyboard.append([InlineKeyboardButton(f"📧 {email.email_address}", callback_data=f"digest_{email.id}_show")])
+        keyboard.append(row)
+    
+    return message, InlineKeyboardMarkup(keyboard)
+
+
+async def _user_emails(session, telegram_id: int):
+    result = await session.execute(
+        select(UserEmail)
+        .where(UserEmail.user_id == telegram_id)
+        .order_by(UserEmail.id)
+    )
+    return result.scalars().all()
+
+
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /digest command - Choose instant delivery or a digest window per address
+    """
+    user = update.effective_user
+    
+    async with AsyncSessionLocal() as session:
+        user_emails = await _user_emails(session, user.id)
+    
+    if not user_emails:
+        await update.message.reply_text(
+            "📭 You don't have any email addresses yet.\n\nUse /add_email to create one!",
+            parse_mode="HTML"
+        )
+        return
+    
+    message, reply_markup = build_digest_menu(user_emails)
+    await update.message.reply_text(message, reply_markup=reply_markup, parse_mode="HTML")
+    logger.info(f"User {user.id} opened digest settings")
+
+
+async def handle_digest_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Handle digest window selection (format: "digest_<alias id>_<minutes>")
+    """
+    query = update.callback_query
+    await query.answer()
+    
+    user = update.effective_user
+    _, alias_id, choice = query.data.split("_", 2)
+    
+    # The address row is only a label
+    if choice == "show":
+        return
+    
+    minutes = int(choice) if choice.isdigit() else -1
+    if minutes != 0 and minutes not in DIGEST_WINDOWS:
+        await query.edit_message_text("❌ Invalid option. Please try /digest again.", parse_mode="HTML")
+        return
+    
+    async with AsyncSessionLocal() as session:
+        email = await session.get(UserEmail, int(alias_id))
+        if not email or email.user_id != user.id:
+            await query.edit_message_text("❌ Email address not found. Please try /digest again.", parse_mode="HTML")
+            return
+        
+        # Telegram rejects an edit that changes nothing
+        if email.digest_window == minutes * 60:
+            return
+        
+        email.digest_window = minutes * 60
+        await session.commit()
+        # New mail for this address must see the new mode right away
+        routing_cache.invalidate(email.email_address)
+        logger.info(f"User {user.id} set digest window of {email.email_address} to {minutes} minute(s)")
+        
+        user_emails = await _user_emails(session, user.id)
+    
+    message, reply_markup = build_digest_menu(user_emails)
+    await query.edit_message_text(message, reply_markup=reply_markup, parse_mode="HTML")
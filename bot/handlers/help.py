@@ -38,6 +38,7 @@ This bot allows you to create custom email addresses that forward all incoming e
 /credits - Check balance and buy credits
 /add_email - Create a new email address
 /my_emails - View all your email addresses
+/digest - Bundle busy addresses into periodic summaries
 /help - Show this help message
 
 <b>💰 Pricing:</b>
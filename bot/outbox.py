@@ -0,0 +1,434 @@
+"""
+Notification Outbox
+Rendered Telegram API calls are stored in the outbox_messages table in the
+same transaction as the email log, then delivered by a background
+dispatcher that retries with jittered exponential backoff
+"""
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+import asyncio
+import json
+import logging
+import random
+import uuid
+
+from sqlalchemy import select, update, delete, insert, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from telegram.error import BadRequest, Forbidden, InvalidToken, RetryAfter
+
+from config import (
+    OUTBOX_DIR, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_LEASE_SECONDS,
+    OUTBOX_BASE_DELAY, OUTBOX_MAX_DELAY, OUTBOX_MAX_ATTEMPTS, DELIVERY_WORKERS
+)
+from database import AsyncSessionLocal, OutboxMessage, OutboxStatus
+from bot.bot import execute_call, call_files
+from bot.clients import bot_clients
+from bot.delivery import retry_after_seconds
+from bot.digest import DIGEST_METHOD, digest_call, claim_digest, render_digest, release_digest
+
+logger = logging.getLogger(__name__)
+
+# Errors that will not succeed on retry (blocked bot, bad chat, malformed call)
+PERMANENT_ERRORS = (BadRequest, Forbidden, InvalidToken)
+
+
+async def enqueue_calls(session: AsyncSession, chat_id: int, calls: List[dict],
+                        email_log_id: Optional[int] = None, delay: float = 0):
+    """
+    Add rendered calls for one chat to the outbox within the caller's transaction
+    
+    Rows are delivered in insertion order per chat, no sooner than
+    delay seconds from now.
+    """
+    if not calls:
+        return
+    
+    now = datetime.utcnow()
+    due = now + timedelta(seconds=delay)
+    await session.execute(
+        insert(OutboxMessage),
+        [
+            {
+                "chat_id": chat_id,
+                "email_log_id": email_log_id,
+                "method": call['method'],
+                "payload": json.dumps(call),
+                "file_paths": "\n".join(call_files(call)) or None,
+                "status": OutboxStatus.PENDING,
+                "attempts": 0,
+                "next_attempt_at": due,
+                "created_at": now,
+            }
+            for call in calls
+        ]
+    )
+
+
+class OutboxDispatcher:
+    """
+    Background dispatcher for the notification outbox
+    
+    Claims due rows in batches with a lease (claimed_by/claimed_until),
+    so rows held by a dispatcher that stopped are picked up again once
+    the lease expires. Rows for the same chat are sent strictly in ID
+    order: a chat is skipped while an earlier row of it is waiting for a
+    retry. Scheduled digests wait for their window without holding back
+    the chat's other rows.
+    
+    Claimed rows are handed to a fixed pool of delivery workers sharded
+    by chat ID (chat_id % worker_count), so each chat is served by one
+    worker in order while different chats proceed in parallel. At most
+    batch_size rows are outstanding at a time; their leases are renewed
+    while they wait or are being sent, and their chats are not claimed
+    again until they are done, so a slow shard never sends a row twice.
+    """
+    
+    def __init__(self, batch_size: int = 50, poll_interval: float = 5,
+                 lease_seconds: float = 300, base_delay: float = 5,
+                 max_delay: float = 3600, max_attempts: int = 10,
+                 worker_count: int = 8, stop_timeout: float = 5):
+        self.batch_size = batch_size
+        self.worker_count = max(1, worker_count)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.stop_timeout = stop_timeout
+        self.bot_app = None
+        self._token = uuid.uuid4().hex
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self._shards: List[asyncio.Queue] = []
+        self._workers: List[asyncio.Task] = []
+        self._renewal: Optional[asyncio.Task] = None
+        # Claimed row ID -> chat ID, until a delivery worker is done with it
+        self._outstanding: Dict[int, int] = {}
+    
+    async def start(self, bot_app):
+        """Remove orphaned upload files and start dispatching"""
+        self.bot_app = bot_app
+        Path(OUTBOX_DIR).mkdir(parents=True, exist_ok=True)
+        await self._sweep_files()
+        self._shards = [asyncio.Queue() for _ in range(self.worker_count)]
+        self._workers = [asyncio.create_task(self._worker(shard)) for shard in self._shards]
+        self._task = asyncio.create_task(self._run())
+        self._renewal = asyncio.create_task(self._renew_leases())
+        logger.info(f"✅ Outbox dispatcher started ({self.worker_count} delivery worker(s))")
+    
+    async def stop(self):
+        """Stop dispatching; claimed rows are retried after their lease expires"""
+        self._stopping = True
+        self._wake.set()
+        tasks = [task for task in (self._task, self._renewal) if task] + self._workers
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            _, still_running = await asyncio.wait(tasks, timeout=self.stop_timeout)
+            if still_running:
+                logger.warning(f"⚠️ {len(still_running)} outbox task(s) did not stop within {self.stop_timeout}s")
+        self._task = None
+        self._renewal = None
+        self._workers = []
+        self._shards = []
+        self._outstanding.clear()
+        self._stopping = False
+        self._wake.clear()
+    
+    def wake(self):
+        """Dispatch immediately instead of waiting for the next poll"""
+        self._wake.set()
+    
+    async def _run(self):
+        while not self._stopping:
+            try:
+                claimed = await self.dispatch_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}")
+                claimed = 0
+            
+            # A full claim means more rows are probably due right now
+            if claimed and len(self._outstanding) < self.batch_size:
+                continue
+            
+            # Not wait_for: on Python 3.11 it can swallow the cancellation
+            # from stop() when wake() fires in the same loop iteration
+            waiter = asyncio.ensure_future(self._wake.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=self.poll_interval)
+            finally:
+                waiter.cancel()
+            self._wake.clear()
+    
+    async def dispatch_once(self) -> int:
+        """Claim due rows and hand them to the delivery workers; returns the number claimed"""
+        limit = self.batch_size - len(self._outstanding)
+        if limit <= 0:
+            return 0
+        
+        rows = await self._claim(limit)
+        if not rows:
+            return 0
+        
+        by_chat = {}
+        for row in rows:
+            by_chat.setdefault(row.chat_id, []).append(row)
+        
+        self._outstanding.update((row.id, row.chat_id) for row in rows)
+        for chat_id, chat_rows in by_chat.items():
+            self._shards[chat_id % self.worker_count].put_nowait(chat_rows)
+        return len(rows)
+    
+    async def _worker(self, shard: asyncio.Queue):
+        """Send the chats of one shard, one chat at a time in claim order"""
+        while True:
+            rows = await shard.get()
+            try:
+                await self._send_chat(rows)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Unsent rows are retried once their lease expires
+                logger.error(f"Outbox delivery to {rows[0].chat_id} failed: {e}")
+            finally:
+                for row in rows:
+                    self._outstanding.pop(row.id, None)
+                # Claim more once half of the batch has drained
+                if len(self._outstanding) <= self.batch_size // 2:
+                    self.wake()
+    
+    @property
+    def depth(self) -> int:
+        """Claimed rows waiting for or being sent by a delivery worker"""
+        return len(self._outstanding)
+    
+    async def _renew_leases(self):
+        """Extend the leases of outstanding rows before they can expire"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            ids = list(self._outstanding)
+            if not ids:
+                continue
+            try:
+                async with AsyncSessionLocal() as session:
+                    await session.execute(
+                        update(OutboxMessage)
+                        .where(OutboxMessage.id.in_(ids))
+                        .where(OutboxMessage.claimed_by == self._token)
+                        .values(claimed_until=datetime.utcnow() + timedelta(seconds=self.lease_seconds))
+                    )
+                    await session.commit()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Outbox lease renewal failed: {e}")
+    
+    async def _claim(self, limit: int) -> List[OutboxMessage]:
+        now = datetime.utcnow()
+        earlier = aliased(OutboxMessage)
+        unclaimed = or_(OutboxMessage.claimed_until.is_(None), OutboxMessage.claimed_until < now)
+        # Still queued or in flight here, even if a renewal was missed
+        outstanding_ids = list(self._outstanding)
+        busy_chats = set(self._outstanding.values())
+        
+        async with AsyncSessionLocal() as session:
+            # Skip chats whose earlier rows are backing off or held by another dispatcher
+            blocked = (
+                select(earlier.id)
+                .where(earlier.chat_id == OutboxMessage.chat_id)
+                .where(earlier.id < OutboxMessage.id)
+                .where(earlier.status == OutboxStatus.PENDING)
+                .where(earlier.method != DIGEST_METHOD)
+                .where(or_(
+                    earlier.next_attempt_at > now,
+                    and_(earlier.claimed_until.is_not(None), earlier.claimed_until >= now)
+                ))
+                .exists()
+            )
+            due_ids = (await session.scalars(
+                select(OutboxMessage.id)
+                .where(OutboxMessage.status == OutboxStatus.PENDING)
+                .where(OutboxMessage.next_attempt_at <= now)
+                .where(unclaimed)
+                .where(OutboxMessage.id.not_in(outstanding_ids))
+                .where(OutboxMessage.chat_id.not_in(busy_chats))
+                .where(~blocked)
+                .order_by(OutboxMessage.id)
+                .limit(limit)
+            )).all()
+            
+            if not due_ids:
+                return []
+            
+            # Rows another dispatcher claimed in the meantime are not returned
+            claimed = (await session.scalars(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_(due_ids))
+                .where(unclaimed)
+                .values(claimed_by=self._token, claimed_until=now + timedelta(seconds=self.lease_seconds))
+                .returning(OutboxMessage)
+            )).all()
+            await session.commit()
+            return sorted(claimed, key=lambda row: row.id)
+    
+    async def _send_chat(self, rows: List[OutboxMessage]):
+        for idx, row in enumerate(rows):
+            if not await self._send(row):
+                # Keep per-chat order: release later rows until this one succeeds
+                await self._release([r.id for r in rows[idx + 1:]])
+                return
+    
+    async def _send(self, row: OutboxMessage) -> bool:
+        """Send one row; returns False if it was rescheduled"""
+        call = json.loads(row.payload)
+        try:
+            if not self.bot_app:
+                raise RuntimeError("Bot application not available")
+            if call['method'] == DIGEST_METHOD:
+                await self._send_digest(row, call)
+            else:
+                await execute_call(bot_clients.for_call(call, self.bot_app.bot), row.chat_id, call)
+        except asyncio.CancelledError:
+            raise
+        except PERMANENT_ERRORS as e:
+            logger.error(f"Outbox message {row.id} to {row.chat_id} failed permanently: {e}")
+            await self._finish(row, OutboxStatus.FAILED, str(e))
+            return True
+        except Exception as e:
+            return await self._retry(row, e)
+        
+        await self._finish(row, None, None)
+        return True
+    
+    async def _send_digest(self, row: OutboxMessage, call: dict):
+        """Claim the alias's waiting emails and send them as summary messages"""
+        alias = call['params']['alias']
+        async with AsyncSessionLocal() as session:
+            entries = await claim_digest(session, row.id, row.chat_id, alias)
+            await session.commit()
+        
+        for summary in render_digest(alias, entries):
+            await execute_call(bot_clients.for_call(summary, self.bot_app.bot), row.chat_id, summary)
+        
+        async with AsyncSessionLocal() as session:
+            if await release_digest(session, row.id, row.chat_id, alias):
+                # Arrived while this digest was claiming; they already waited
+                await enqueue_calls(session, row.chat_id, [digest_call(alias)])
+                self.wake()
+            await session.commit()
+        
+        if entries:
+            logger.info(f"🗞 Digest of {len(entries)} email(s) for {alias} sent to {row.chat_id}")
+    
+    async def _retry(self, row: OutboxMessage, error: Exception) -> bool:
+        """Reschedule a row with backoff; returns True if it was given up instead"""
+        attempts = row.attempts + 1
+        if attempts >= self.max_attempts:
+            logger.error(f"Outbox message {row.id} to {row.chat_id} gave up after {attempts} attempts: {error}")
+            await self._finish(row, OutboxStatus.FAILED, str(error))
+            return True
+        
+        # Exponential backoff with full jitter, never sooner than Telegram asked
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempts))
+        if isinstance(error, RetryAfter):
+            delay = max(delay, retry_after_seconds(error))
+        
+        logger.warning(
+            f"Outbox message {row.id} to {row.chat_id} failed (attempt {attempts}): {error} "
+            f"- retrying in {delay:.0f}s"
+        )
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id == row.id)
+                .values(
+                    attempts=attempts,
+                    next_attempt_at=datetime.utcnow() + timedelta(seconds=delay),
+                    claimed_by=None,
+                    claimed_until=None,
+                    last_error=str(error),
+                )
+            )
+            await session.commit()
+        return False
+    
+    async def _release(self, ids: List[int]):
+        if not ids:
+            return
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_(ids))
+                .where(OutboxMessage.claimed_by == self._token)
+                .values(claimed_by=None, claimed_until=None)
+            )
+            await session.commit()
+    
+    async def _finish(self, row: OutboxMessage, status: Optional[OutboxStatus], error: Optional[str]):
+        """Delete a delivered row (status None) or mark it failed, then drop unused files"""
+        async with AsyncSessionLocal() as session:
+            if status is None:
+                await session.execute(delete(OutboxMessage).where(OutboxMessage.id == row.id))
+            else:
+                await session.execute(
+                    update(OutboxMessage)
+                    .where(OutboxMessage.id == row.id)
+                    .values(status=status, attempts=row.attempts + 1, claimed_by=None,
+                            claimed_until=None, last_error=error)
+                )
+            
+            # Fan-out rows share files; keep each until the last row using it is done
+            paths = row.file_paths.split("\n") if row.file_paths else []
+            still_used = set()
+            if paths:
+                names = [Path(path).name for path in paths]
+                for other in (await session.scalars(
+                    select(OutboxMessage.file_paths)
+                    .where(OutboxMessage.status == OutboxStatus.PENDING)
+                    .where(OutboxMessage.id != row.id)
+                    .where(or_(*(OutboxMessage.file_paths.contains(name) for name in names)))
+                )).all():
+                    still_used.update(Path(path).name for path in other.split("\n"))
+            await session.commit()
+        
+        for path in paths:
+            if Path(path).name not in still_used:
+                Path(path).unlink(missing_ok=True)
+    
+    async def _sweep_files(self):
+        async with AsyncSessionLocal() as session:
+            referenced = set(
+                Path(path).name
+                for paths in (await session.scalars(
+                    select(OutboxMessage.file_paths)
+                    .where(OutboxMessage.file_paths.is_not(None))
+                    .where(OutboxMessage.status == OutboxStatus.PENDING)
+                )).all()
+                for path in paths.split("\n")
+            )
+        
+        removed = 0
+        for path in Path(OUTBOX_DIR).iterdir():
+            if path.name not in referenced:
+                path.unlink(missing_ok=True)
+                removed += 1
+        if removed:
+            logger.info(f"Removed {removed} orphaned outbox file(s)")
+
+
+# Process-wide outbox dispatcher
+outbox_dispatcher = OutboxDispatcher(
+    batch_size=OUTBOX_BATCH_SIZE,
+    poll_interval=OUTBOX_POLL_INTERVAL,
+    lease_seconds=OUTBOX_LEASE_SECONDS,
+    base_delay=OUTBOX_BASE_DELAY,
+    max_delay=OUTBOX_MAX_DELAY,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    worker_count=DELIVERY_WORKERS,
+)
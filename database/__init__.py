@@ -2,8 +2,18 @@
 Database package initialization
 """
 
-from .models import Base, User, Domain, UserEmail, EmailLog, Transaction, TransactionStatus
+from .models import (
+    Base, User, Domain, UserEmail, EmailLog, ProcessedEmail, TelegramFile,
+    DigestEntry, EmailAttachment,
+    OutboxMessage, OutboxStatus, Transaction, TransactionStatus, SchemaMigration
+)
 from .database import engine, AsyncSessionLocal, init_db, get_db, get_session
+from .migrations import MIGRATIONS, migrate
+from .dedup import DedupStore, dedup_store, make_dedup_key
+from .file_ids import FileIdCache, file_id_cache
+from .bloom import AddressBloomFilter, address_filter
+from .attachments import AttachmentStore, attachment_store
+from .routing import Route, RoutingCache, routing_cache, notify_routing_change
 
 __all__ = [
     'Base',
@@ -11,11 +21,33 @@ __all__ = [
     'Domain',
     'UserEmail',
     'EmailLog',
+    'ProcessedEmail',
+    'TelegramFile',
+    'DigestEntry',
+    'EmailAttachment',
+    'OutboxMessage',
+    'OutboxStatus',
     'Transaction',
     'TransactionStatus',
+    'SchemaMigration',
     'engine',
     'AsyncSessionLocal',
     'init_db',
     'get_db',
     'get_session',
+    'MIGRATIONS',
+    'migrate',
+    'DedupStore',
+    'dedup_store',
+    'make_dedup_key',
+    'FileIdCache',
+    'file_id_cache',
+    'AttachmentStore',
+    'attachment_store',
+    'AddressBloomFilter',
+    'address_filter',
+    'Route',
+    'RoutingCache',
+    'routing_cache',
+    'notify_routing_change',
 ]
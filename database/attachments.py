@@ -0,0 +1,124 @@
+"""
+Attachment Store
+Keeps attachments of emails that are not delivered right away (digests),
+so they can be sent when the user asks for the full email. Files are
+stored once per SHA-256 and shared by every email that carries them.
+"""
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterable, List
+import asyncio
+import logging
+import os
+import shutil
+
+from sqlalchemy import select, delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import ATTACHMENT_STORE_DIR, ATTACHMENT_RETENTION_DAYS
+from database.database import AsyncSessionLocal
+from database.models import EmailAttachment
+
+logger = logging.getLogger(__name__)
+
+
+class AttachmentStore:
+    """
+    Content-addressed attachment files described by email_attachments rows
+    
+    Files are copied by keep() before the caller's transaction, so it
+    only writes the rows; files without a row (rolled back or expired)
+    are removed by purge_expired().
+    """
+    
+    def __init__(self, directory: str, retention_days: float = 30):
+        self.directory = Path(directory)
+        self.retention = timedelta(days=retention_days)
+    
+    def path(self, sha256: str) -> Path:
+        return self.directory / sha256
+    
+    def _keep(self, source: str, sha256: str):
+        target = self.path(sha256)
+        if target.exists():
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        try:
+            # The source stays in place for instant deliveries of the same email
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+    
+    async def keep(self, attachments: List[dict]):
+        """Store the attachment files (off the event loop; copies may be large)"""
+        attachments = [a for a in attachments if a.get('size') and a.get('sha256')]
+        for attachment in attachments:
+            await asyncio.to_thread(self._keep, attachment['path'], attachment['sha256'])
+    
+    async def save(self, session: AsyncSession, email_log_ids: Iterable[int], attachments: List[dict]):
+        """Link attachment files stored by keep() to each email log"""
+        attachments = [a for a in attachments if a.get('size') and a.get('sha256')]
+        email_log_ids = list(email_log_ids)
+        if not attachments or not email_log_ids:
+            return
+        
+        now = datetime.utcnow()
+        await session.execute(
+            insert(EmailAttachment),
+            [
+                {
+                    "email_log_id": email_log_id,
+                    "filename": attachment.get('filename', 'unnamed'),
+                    "content_type": attachment.get('content_type', 'application/octet-stream'),
+                    "size": attachment['size'],
+                    "sha256": attachment['sha256'],
+                    "created_at": now,
+                }
+                for email_log_id in email_log_ids
+                for attachment in attachments
+            ]
+        )
+    
+    async def load(self, session: AsyncSession, email_log_id: int) -> List[dict]:
+        """Attachment dicts (as produced by the parser) still available for an email"""
+        rows = (await session.scalars(
+            select(EmailAttachment)
+            .where(EmailAttachment.email_log_id == email_log_id)
+            .order_by(EmailAttachment.id)
+        )).all()
+        
+        return [
+            {
+                'filename': row.filename,
+                'content_type': row.content_type,
+                'size': row.size,
+                'sha256': row.sha256,
+                'path': str(self.path(row.sha256)),
+            }
+            for row in rows
+            if self.path(row.sha256).exists()
+        ]
+    
+    async def purge_expired(self):
+        """Drop rows past the retention period and files no row refers to"""
+        cutoff = datetime.utcnow() - self.retention
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                delete(EmailAttachment).where(EmailAttachment.created_at < cutoff)
+            )
+            await session.commit()
+            referenced = set((await session.scalars(select(EmailAttachment.sha256).distinct())).all())
+        
+        removed = 0
+        if self.directory.exists():
+            for path in self.directory.iterdir():
+                if path.name not in referenced:
+                    path.unlink(missing_ok=True)
+                    removed += 1
+        if result.rowcount or removed:
+            logger.info(f"Purged {result.rowcount} expired attachment record(s) and {removed} file(s)")
+
+
+# Process-wide attachment store
+attachment_store = AttachmentStore(ATTACHMENT_STORE_DIR, ATTACHMENT_RETENTION_DAYS)
@@ -0,0 +1,149 @@
+"""
+Registered Address Bloom Filter
+Compact probabilistic membership test over every UserEmail.email_address,
+used to drop mail for unknown addresses without touching the database
+"""
+
+from pathlib import Path
+from typing import Iterable, Optional
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import struct
+
+from sqlalchemy import select
+
+from config import BLOOM_CAPACITY, BLOOM_FP_RATE, BLOOM_FILE
+from database.database import AsyncSessionLocal
+from database.models import UserEmail
+
+logger = logging.getLogger(__name__)
+
+# File header: magic, bit count, hash count, item count, highest alias ID included
+_HEADER = struct.Struct("<4sQIQQ")
+_MAGIC = b"E2TB"
+
+
+class AddressBloomFilter:
+    """
+    Bloom filter sized from a capacity and target false-positive rate
+    
+    Never gives false negatives for addresses that were added, so a
+    "no" answer is always safe to act on. Until the filter has been
+    loaded or built, every lookup answers "maybe" so nothing is dropped.
+    
+    Persisted with the highest UserEmail.id it contains; on startup only
+    aliases created after that ID are added, instead of a full rebuild.
+    """
+    
+    def __init__(self, capacity: int = 1000000, fp_rate: float = 0.001,
+                 path: Optional[str] = None):
+        self.capacity = max(1, capacity)
+        self.fp_rate = fp_rate
+        self.path = Path(path) if path else None
+        
+        self.num_bits = max(8, int(-self.capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.max_alias_id = 0
+        self.ready = False
+    
+    def _positions(self, address: str):
+        digest = hashlib.blake2b(address.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+    
+    def add(self, address: str, alias_id: Optional[int] = None):
+        """Add an address (alias_id advances the persisted high-water mark)"""
+        for pos in self._positions(address):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        if alias_id and alias_id > self.max_alias_id:
+            self.max_alias_id = alias_id
+        
+        if self.count == self.capacity + 1:
+            logger.warning(
+                f"Address bloom filter exceeded its capacity ({self.capacity}); "
+                f"false-positive rate will rise - increase BLOOM_CAPACITY"
+            )
+    
+    def might_contain(self, address: str) -> bool:
+        """False means the address is definitely not registered"""
+        if not self.ready:
+            return True
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(address))
+    
+    def filter(self, addresses: Iterable[str]) -> list:
+        """Keep only addresses that may be registered"""
+        return [address for address in addresses if self.might_contain(address)]
+    
+    def _load_file(self) -> bool:
+        if not self.path or not self.path.exists():
+            return False
+        
+        with open(self.path, "rb") as f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                return False
+            magic, num_bits, num_hashes, count, max_alias_id = _HEADER.unpack(header)
+            if magic != _MAGIC or num_bits != self.num_bits or num_hashes != self.num_hashes:
+                # Sizing changed (or foreign file) - rebuild from the database
+                return False
+            bits = f.read()
+        
+        if len(bits) != len(self.bits):
+            return False
+        
+        self.bits = bytearray(bits)
+        self.count = count
+        self.max_alias_id = max_alias_id
+        return True
+    
+    def _save_file(self):
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, self.num_bits, self.num_hashes, self.count, self.max_alias_id))
+            f.write(self.bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+    
+    async def load(self):
+        """Load the persisted filter and add aliases created since it was saved"""
+        loaded = await asyncio.to_thread(self._load_file)
+        if not loaded:
+            self.bits = bytearray(len(self.bits))
+            self.count = 0
+            self.max_alias_id = 0
+        
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(UserEmail.id, UserEmail.email_address)
+                .where(UserEmail.id > self.max_alias_id)
+            )
+            added = 0
+            for alias_id, address in result.all():
+                self.add(address, alias_id)
+                added += 1
+        
+        self.ready = True
+        source = "loaded from disk" if loaded else "built from database"
+        logger.info(f"✅ Address bloom filter {source} ({self.count} address(es), +{added} new)")
+    
+    async def save(self):
+        """Persist the filter so the next startup only needs a catch-up query"""
+        if self.path and self.ready:
+            await asyncio.to_thread(self._save_file)
+
+
+# Process-wide filter over registered addresses
+address_filter = AddressBloomFilter(
+    capacity=BLOOM_CAPACITY,
+    fp_rate=BLOOM_FP_RATE,
+    path=BLOOM_FILE,
+)
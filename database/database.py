@@ -1,24 +1,110 @@
 """
 Database Connection and Session Management
-Async SQLAlchemy setup with SQLite
+Async SQLAlchemy setup with SQLite (WAL mode) or PostgreSQL (asyncpg)
 """
 
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.pool import StaticPool
-from config import DATABASE_URL
-from database.models import Base
+from config import (
+    DATABASE_URL, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT,
+    DATABASE_POOL_RECYCLE, DATABASE_STATEMENT_CACHE_SIZE,
+    SQLITE_BUSY_TIMEOUT, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE_KB
+)
+from database.migrations import migrate
 import logging
+import uuid
 
 logger = logging.getLogger(__name__)
 
+
+def _engine_options(url: str) -> dict:
+    """
+    Pool settings for the configured database
+    
+    PostgreSQL connections are pinged before use and recycled periodically
+    (the server or a proxy may close idle ones), and keep a cache of
+    prepared statements. With the cache size set to 0 (PgBouncer in
+    transaction pooling mode) neither SQLAlchemy nor asyncpg caches
+    statements, and each prepared statement gets a unique name so a
+    server connection shared between clients never sees a name twice.
+    
+    An in-memory SQLite database exists only on its one connection, so it
+    keeps a StaticPool. File databases get a real pool: readers use their
+    own connections concurrently, and every write transaction starts with
+    BEGIN IMMEDIATE, so writers queue for SQLite's write lock (up to the
+    busy timeout) instead of failing halfway through a transaction.
+    """
+    parsed = make_url(url)
+    pool = {
+        "pool_size": DATABASE_POOL_SIZE,
+        "max_overflow": DATABASE_MAX_OVERFLOW,
+        "pool_timeout": DATABASE_POOL_TIMEOUT,
+    }
+    
+    if parsed.get_backend_name() == "postgresql":
+        connect_args = {
+            # SQLAlchemy's cache of prepared statements and asyncpg's own
+            "prepared_statement_cache_size": DATABASE_STATEMENT_CACHE_SIZE,
+            "statement_cache_size": DATABASE_STATEMENT_CACHE_SIZE,
+            "server_settings": {"application_name": "email2telegram"},
+        }
+        if DATABASE_STATEMENT_CACHE_SIZE == 0:
+            connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid.uuid4()}__"
+        return {
+            **pool,
+            "pool_pre_ping": True,
+            "pool_recycle": DATABASE_POOL_RECYCLE,
+            "connect_args": connect_args,
+        }
+    
+    database = parsed.database
+    if not database or database == ":memory:" or "mode=memory" in url:
+        return {
+            "connect_args": {"check_same_thread": False},
+            "poolclass": StaticPool,
+        }
+    
+    return {
+        **pool,
+        "connect_args": {
+            "check_same_thread": False,
+            "isolation_level": "IMMEDIATE",
+            "timeout": SQLITE_BUSY_TIMEOUT,
+        },
+    }
+
+
 # Create async engine
 engine = create_async_engine(
     DATABASE_URL,
     echo=False,  # Set to True for SQL query logging
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
+    **_engine_options(DATABASE_URL),
 )
 
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    """
+    Tune every new SQLite connection
+    
+    WAL lets readers proceed while a write is in progress; synchronous=NORMAL
+    is durable in WAL mode except for the last transactions before a power loss.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    # Negative cache_size is in KiB rather than pages
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine.sync_engine, "connect", _configure_sqlite)
+
 # Create async session factory
 AsyncSessionLocal = async_sessionmaker(
     engine,
@@ -29,11 +115,11 @@ AsyncSessionLocal = async_sessionmaker(
 
 async def init_db():
     """
-    Initialize database - create all tables
+    Initialize database - create missing tables and apply schema migrations
     """
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
-    logger.info("✅ Database initialized successfully")
+        version = await conn.run_sync(migrate)
+    logger.info(f"✅ Database initialized successfully (schema version {version})")
 
 
 async def get_session() -> AsyncSession:
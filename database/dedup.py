@@ -0,0 +1,131 @@
+"""
+Email Idempotency Store
+Drops duplicate webhook deliveries (Cloudflare retries, MTA redeliveries)
+keyed on Message-ID + recipient, with a body hash fallback
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Set
+import hashlib
+import logging
+import time
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import DEDUP_TTL, DEDUP_CACHE_SIZE
+from database.database import AsyncSessionLocal
+from database.models import ProcessedEmail
+
+logger = logging.getLogger(__name__)
+
+# INSERT ... ON CONFLICT DO NOTHING for the supported backends
+_CONFLICT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def make_dedup_key(message_id: Optional[str], body: bytes, recipient: str) -> str:
+    """Build the idempotency key for one recipient of a message"""
+    identity = message_id.strip() if message_id else "sha256:" + hashlib.sha256(body).hexdigest()
+    return hashlib.sha256(f"{identity}|{recipient}".encode()).hexdigest()
+
+
+class DedupStore:
+    """
+    Bounded TTL cache in front of the processed_emails table
+    
+    Keys map to the EmailLog ID created by the first delivery.
+    Rows are written in the same transaction as the EmailLog rows,
+    so a key only exists once the email was actually logged.
+    """
+    
+    def __init__(self, ttl: float = 604800, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    def _remember(self, key: str, email_log_id: Optional[int]):
+        self._entries[key] = (email_log_id, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    async def seen(self, keys: Iterable[str]) -> Dict[str, Optional[int]]:
+        """Return the already-processed keys with their original EmailLog IDs"""
+        found = {}
+        misses = []
+        now = time.monotonic()
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry and entry[1] >= now:
+                found[key] = entry[0]
+            else:
+                misses.append(key)
+        
+        if misses:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+            async with AsyncSessionLocal() as session:
+                result = await session.execute(
+                    select(ProcessedEmail.dedup_key, ProcessedEmail.email_log_id)
+                    .where(ProcessedEmail.dedup_key.in_(misses))
+                    .where(ProcessedEmail.created_at >= cutoff)
+                )
+                for key, email_log_id in result.all():
+                    found[key] = email_log_id
+                    self._remember(key, email_log_id)
+        
+        return found
+    
+    async def record(self, session: AsyncSession, keys: Dict[str, Optional[int]]) -> Set[str]:
+        """
+        Add processed keys within the caller's transaction
+        
+        Expired rows for these keys (not purged yet) are replaced. Returns
+        the keys another transaction recorded first: the caller must roll
+        back, since those messages were delivered concurrently. The
+        in-memory layer is only updated via remember_committed() once the
+        transaction has committed.
+        """
+        if not keys:
+            return set()
+        
+        now = datetime.utcnow()
+        cutoff = now - timedelta(seconds=self.ttl)
+        await session.execute(
+            delete(ProcessedEmail)
+            .where(ProcessedEmail.dedup_key.in_(list(keys)))
+            .where(ProcessedEmail.created_at < cutoff)
+        )
+        
+        insert = _CONFLICT_INSERTS[session.bind.dialect.name]
+        result = await session.scalars(
+            insert(ProcessedEmail)
+            .values([
+                {"dedup_key": key, "email_log_id": email_log_id, "created_at": now}
+                for key, email_log_id in keys.items()
+            ])
+            .on_conflict_do_nothing(index_elements=[ProcessedEmail.dedup_key])
+            .returning(ProcessedEmail.dedup_key)
+        )
+        return set(keys) - set(result.all())
+    
+    def remember_committed(self, keys: Dict[str, Optional[int]]):
+        """Cache keys whose rows have been committed"""
+        for key, email_log_id in keys.items():
+            self._remember(key, email_log_id)
+    
+    async def purge_expired(self):
+        """Delete keys older than the TTL"""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                delete(ProcessedEmail).where(ProcessedEmail.created_at < cutoff)
+            )
+            await session.commit()
+        if result.rowcount:
+            logger.info(f"Purged {result.rowcount} expired idempotency key(s)")
+
+
+# Process-wide idempotency store used by the ingest pipeline
+dedup_store = DedupStore(ttl=DEDUP_TTL, max_entries=DEDUP_CACHE_SIZE)
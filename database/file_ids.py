@@ -0,0 +1,87 @@
+"""
+Telegram File ID Cache
+Maps attachment content (SHA-256) to the file_id Telegram returned on the
+first upload, so repeated logos, signatures and PDFs are sent by reference
+"""
+
+from collections import OrderedDict
+from typing import Optional
+import logging
+
+from sqlalchemy import delete
+
+from config import FILE_ID_CACHE_SIZE
+from database.database import AsyncSessionLocal
+from database.models import TelegramFile
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """
+    LRU cache in front of the telegram_files table
+    
+    A file_id only works with the send method it came from, so entries
+    are keyed by (sha256, kind) where kind is photo, document or animation.
+    """
+    
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+    
+    def _remember(self, key: tuple, file_id: str):
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    async def get(self, sha256: Optional[str], kind: str) -> Optional[str]:
+        """Return the cached file_id for this content, if it was uploaded before"""
+        if not sha256:
+            return None
+        
+        key = (sha256, kind)
+        file_id = self._entries.get(key)
+        if file_id:
+            self._entries.move_to_end(key)
+            return file_id
+        
+        async with AsyncSessionLocal() as session:
+            row = await session.get(TelegramFile, key)
+        if row:
+            self._remember(key, row.file_id)
+            return row.file_id
+        return None
+    
+    async def store(self, sha256: Optional[str], kind: str, file_id: Optional[str]):
+        """Record the file_id Telegram returned for an upload"""
+        if not sha256 or not file_id:
+            return
+        
+        key = (sha256, kind)
+        if self._entries.get(key) == file_id:
+            return
+        self._remember(key, file_id)
+        
+        async with AsyncSessionLocal() as session:
+            await session.merge(TelegramFile(sha256=sha256, kind=kind, file_id=file_id))
+            await session.commit()
+    
+    async def forget(self, sha256: Optional[str], kind: str):
+        """Drop a file_id Telegram no longer accepts"""
+        if not sha256:
+            return
+        
+        self._entries.pop((sha256, kind), None)
+        async with AsyncSessionLocal() as session:
+            await session.execute(
+                delete(TelegramFile)
+                .where(TelegramFile.sha256 == sha256)
+                .where(TelegramFile.kind == kind)
+            )
+            await session.commit()
+        logger.info(f"Dropped stale Telegram file_id for {sha256[:12]}… ({kind})")
+
+
+# Process-wide file_id cache
+file_id_cache = FileIdCache(max_entries=FILE_ID_CACHE_SIZE)
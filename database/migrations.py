@@ -0,0 +1,102 @@
+"""
+Schema Migrations
+Forward-only migrations applied at startup and recorded in schema_migrations
+
+create_all() creates missing tables with the current schema but never
+changes existing ones; migrations bring tables of older databases up to
+date. Each migration is idempotent, so it can also run against tables
+that create_all() just created.
+"""
+
+from datetime import datetime
+from typing import Callable, List, NamedTuple
+import logging
+
+from sqlalchemy import Connection, inspect, insert, select, text
+from sqlalchemy.schema import CreateColumn
+
+from database.models import Base, SchemaMigration, UserEmail, EmailLog
+
+logger = logging.getLogger(__name__)
+
+# Serialises migrations if an old and a new process overlap during a restart (PostgreSQL)
+MIGRATION_LOCK_ID = 0x656D3274
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[Connection], None]
+
+
+def _add_column(connection: Connection, model, name: str):
+    """Add a model column missing from an existing table"""
+    table = model.__table__
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    if name in existing:
+        return
+    
+    column = CreateColumn(table.c[name]).compile(dialect=connection.dialect)
+    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column}"))
+
+
+def _create_indexes(connection: Connection, model, *names: str):
+    """Create indexes declared on a model if the table lacks them"""
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+
+def _digest_columns(connection: Connection):
+    _add_column(connection, UserEmail, "digest_window")
+    _add_column(connection, EmailLog, "body_plain")
+
+
+def _alias_listing_index(connection: Connection):
+    _create_indexes(connection, UserEmail, "ix_user_emails_user_id_id")
+
+
+# One step per change to a table of the original schema (users, domains,
+# user_emails, email_logs, transactions), in the order the changes were made;
+# tables added since then are created in their current form by create_all()
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Digest windows and plain-text bodies", _digest_columns),
+    Migration(2, "Composite index for alias listing", _alias_listing_index),
+]
+
+
+def migrate(connection: Connection) -> int:
+    """
+    Create missing tables and apply pending migrations in version order
+    
+    Runs within the caller's transaction.
+    
+    Returns:
+        Schema version of the database afterwards
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+    
+    Base.metadata.create_all(connection)
+    
+    applied = set(connection.scalars(select(SchemaMigration.version)).all())
+    known = {migration.version for migration in MIGRATIONS}
+    if applied - known:
+        logger.warning(f"⚠️ Database has migrations this version doesn't know: {sorted(applied - known)}")
+    
+    for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+        if migration.version in applied:
+            continue
+        
+        migration.apply(connection)
+        connection.execute(
+            insert(SchemaMigration).values(
+                version=migration.version,
+                description=migration.description,
+                applied_at=datetime.utcnow(),
+            )
+        )
+        applied.add(migration.version)
+        logger.info(f"🛠 Applied schema migration {migration.version}: {migration.description}")
+    
+    return max(applied, default=0)
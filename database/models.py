@@ -3,7 +3,7 @@ Database Models
 SQLAlchemy ORM models for the Email2Telegram service
 """
 
-from sqlalchemy import BigInteger, String, Integer, DateTime, Boolean, Text, Enum, ForeignKey
+from sqlalchemy import BigInteger, String, Integer, DateTime, Boolean, Text, Enum, ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from datetime import datetime
 from typing import Optional, List
@@ -15,6 +15,12 @@ class Base(DeclarativeBase):
     pass
 
 
+class OutboxStatus(enum.Enum):
+    """Outbox message status enumeration"""
+    PENDING = "pending"
+    FAILED = "failed"
+
+
 class TransactionStatus(enum.Enum):
     """Transaction status enumeration"""
     PENDING = "pending"
@@ -71,11 +77,16 @@ class UserEmail(Base):
     Stores user email addresses (aliases)
     """
     __tablename__ = "user_emails"
+    __table_args__ = (
+        # Alias listings (/my_emails, /digest) per user
+        Index("ix_user_emails_user_id_id", "user_id", "id"),
+    )
     
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     user_id: Mapped[int] = mapped_column(BigInteger, ForeignKey("users.telegram_id"), nullable=False)
     email_address: Mapped[str] = mapped_column(String(255), unique=True, nullable=False)
     domain_id: Mapped[int] = mapped_column(Integer, ForeignKey("domains.id"), nullable=False)
+    digest_window: Mapped[int] = mapped_column(Integer, default=0, server_default="0")  # Seconds; 0 = deliver instantly
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     
     # Relationships
@@ -99,6 +110,7 @@ class EmailLog(Base):
     receiver: Mapped[str] = mapped_column(String(255), nullable=False)
     subject: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
     body_html: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    body_plain: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     raw_content_link: Mapped[Optional[str]] = mapped_column(String(500), nullable=True)
     timestamp: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
     
@@ -109,6 +121,104 @@ class EmailLog(Base):
         return f"<EmailLog(id={self.id}, sender={self.sender}, receiver={self.receiver})>"
 
 
+class ProcessedEmail(Base):
+    """
+    ProcessedEmails Table
+    Idempotency keys (Message-ID + recipient) of delivered emails
+    """
+    __tablename__ = "processed_emails"
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    dedup_key: Mapped[str] = mapped_column(String(64), unique=True, nullable=False)
+    email_log_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("email_logs.id", ondelete="SET NULL"), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f"<ProcessedEmail(id={self.id}, dedup_key={self.dedup_key}, email_log_id={self.email_log_id})>"
+
+
+class TelegramFile(Base):
+    """
+    TelegramFiles Table
+    file_id returned by Telegram for an uploaded attachment, keyed by content hash
+    """
+    __tablename__ = "telegram_files"
+    
+    sha256: Mapped[str] = mapped_column(String(64), primary_key=True)
+    kind: Mapped[str] = mapped_column(String(20), primary_key=True)  # photo / document / animation
+    file_id: Mapped[str] = mapped_column(String(255), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<TelegramFile(sha256={self.sha256}, kind={self.kind})>"
+
+
+class OutboxMessage(Base):
+    """
+    OutboxMessages Table
+    Pending Telegram API calls (one row per call), retried until delivered
+    """
+    __tablename__ = "outbox_messages"
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False, index=True)
+    email_log_id: Mapped[Optional[int]] = mapped_column(Integer, ForeignKey("email_logs.id", ondelete="SET NULL"), nullable=True)
+    method: Mapped[str] = mapped_column(String(50), nullable=False)
+    payload: Mapped[str] = mapped_column(Text, nullable=False)  # JSON-encoded call
+    file_paths: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # Uploaded files, one per line
+    status: Mapped[OutboxStatus] = mapped_column(Enum(OutboxStatus), default=OutboxStatus.PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    claimed_by: Mapped[Optional[str]] = mapped_column(String(64), nullable=True)
+    claimed_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, chat_id={self.chat_id}, method={self.method}, attempts={self.attempts})>"
+
+
+class DigestEntry(Base):
+    """
+    DigestEntries Table
+    Emails waiting to be summarised in the next digest of an alias
+    """
+    __tablename__ = "digest_entries"
+    __table_args__ = (
+        # Waiting entries of an alias (checked for every digest email)
+        Index("ix_digest_entries_chat_id_alias_outbox_id", "chat_id", "alias", "outbox_id"),
+    )
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    alias: Mapped[str] = mapped_column(String(255), nullable=False)
+    email_log_id: Mapped[int] = mapped_column(Integer, ForeignKey("email_logs.id", ondelete="CASCADE"), nullable=False)
+    outbox_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)  # Set once a digest claims it
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<DigestEntry(id={self.id}, alias={self.alias}, email_log_id={self.email_log_id})>"
+
+
+class EmailAttachment(Base):
+    """
+    EmailAttachments Table
+    Attachments kept for on-demand delivery (file stored by SHA-256)
+    """
+    __tablename__ = "email_attachments"
+    
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    email_log_id: Mapped[int] = mapped_column(Integer, ForeignKey("email_logs.id", ondelete="CASCADE"), nullable=False, index=True)
+    filename: Mapped[str] = mapped_column(String(255), nullable=False)
+    content_type: Mapped[str] = mapped_column(String(255), nullable=False)
+    size: Mapped[int] = mapped_column(Integer, nullable=False)
+    sha256: Mapped[str] = mapped_column(String(64), nullable=False, index=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<EmailAttachment(id={self.id}, filename={self.filename}, email_log_id={self.email_log_id})>"
+
+
 class Transaction(Base):
     """
     Transactions Table
@@ -137,3 +247,18 @@ class Transaction(Base):
     
     def __repr__(self):
         return f"<Transaction(id={self.id}, user_id={self.user_id}, amount={self.amount}, status={self.status.value})>"
+
+
+class SchemaMigration(Base):
+    """
+    SchemaMigrations Table
+    Schema migrations applied to this database (see database/migrations.py)
+    """
+    __tablename__ = "schema_migrations"
+    
+    version: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)
+    description: Mapped[str] = mapped_column(String(255), nullable=False)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f"<SchemaMigration(version={self.version}, description={self.description})>"
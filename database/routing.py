@@ -0,0 +1,190 @@
+"""
+Recipient Routing Cache
+In-memory map of email address -> delivery route, so inbound mail
+can be routed without touching the database on the hot path
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional
+import logging
+import time
+
+from sqlalchemy import select
+
+from config import (
+    ROUTING_CACHE_TTL, ROUTING_CACHE_NEGATIVE_TTL,
+    ROUTING_CACHE_MAX_ENTRIES, ROUTING_INVALIDATION_FILE
+)
+from database.bloom import address_filter
+from database.database import AsyncSessionLocal
+from database.models import UserEmail, Domain
+
+logger = logging.getLogger(__name__)
+
+
+class Route(NamedTuple):
+    """Where mail for an address should be delivered"""
+    telegram_id: int
+    alias_id: int
+    domain_active: bool
+    digest_window: int = 0
+
+
+class RoutingCache:
+    """
+    TTL/LRU cache of email routes with negative entries
+    
+    Unknown addresses are cached as None for negative_ttl seconds so
+    repeated spam to the same address doesn't reach the database.
+    
+    Other processes (e.g. scripts/manage_domains.py) can't clear this
+    cache directly, so they touch a marker file via notify_routing_change();
+    the cache compares its mtime at most once per second and drops all
+    entries when it changes.
+    """
+    
+    MARKER_CHECK_INTERVAL = 1.0
+    
+    def __init__(self, ttl: float = 300, negative_ttl: float = 60,
+                 max_entries: int = 100000, marker_path: Optional[str] = None):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.marker_path = Path(marker_path) if marker_path else None
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._marker_mtime = self._read_marker()
+        self._marker_checked = time.monotonic()
+    
+    def _read_marker(self) -> int:
+        if not self.marker_path:
+            return 0
+        try:
+            return self.marker_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return 0
+    
+    def _check_marker(self):
+        now = time.monotonic()
+        if now - self._marker_checked < self.MARKER_CHECK_INTERVAL:
+            return
+        self._marker_checked = now
+        
+        mtime = self._read_marker()
+        if mtime != self._marker_mtime:
+            self._marker_mtime = mtime
+            self.clear()
+            logger.info("Routing cache cleared (external change detected)")
+    
+    def _store(self, address: str, route: Optional[Route]):
+        ttl = self.ttl if route else self.negative_ttl
+        self._entries[address] = (route, time.monotonic() + ttl)
+        self._entries.move_to_end(address)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def get(self, address: str):
+        """
+        Return (hit, route) for an address
+        
+        hit is False when the address is not cached (or expired);
+        a cached unknown address returns (True, None).
+        """
+        entry = self._entries.get(address)
+        if entry is None:
+            return False, None
+        
+        route, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[address]
+            return False, None
+        
+        self._entries.move_to_end(address)
+        return True, route
+    
+    async def resolve(self, addresses: Iterable[str]) -> Dict[str, Route]:
+        """
+        Resolve addresses to routes, loading all misses in one query
+        
+        Returns only the addresses that are registered.
+        """
+        self._check_marker()
+        
+        routes = {}
+        misses = []
+        for address in addresses:
+            hit, route = self.get(address)
+            if not hit:
+                misses.append(address)
+            elif route:
+                routes[address] = route
+        
+        # Addresses the bloom filter rules out are cached as unknown without a query
+        candidates = address_filter.filter(misses)
+        for address in misses:
+            if address not in candidates:
+                self._store(address, None)
+        misses = candidates
+        
+        if misses:
+            loaded = await self._load(misses)
+            for address in misses:
+                route = loaded.get(address)
+                self._store(address, route)
+                if route:
+                    routes[address] = route
+        
+        return routes
+    
+    async def _load(self, addresses: Optional[list] = None) -> Dict[str, Route]:
+        query = (
+            select(UserEmail.email_address, UserEmail.user_id, UserEmail.id, Domain.is_active,
+                   UserEmail.digest_window)
+            .join(Domain, UserEmail.domain_id == Domain.id)
+        )
+        if addresses is not None:
+            query = query.where(UserEmail.email_address.in_(addresses))
+        
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(query)
+            return {
+                address: Route(telegram_id, alias_id, bool(is_active), digest_window or 0)
+                for address, telegram_id, alias_id, is_active, digest_window in result.all()
+            }
+    
+    async def warm(self):
+        """Load every registered address (called at startup)"""
+        self.clear()
+        loaded = await self._load()
+        for address, route in loaded.items():
+            self._store(address, route)
+        logger.info(f"✅ Routing cache warmed with {len(loaded)} address(es)")
+    
+    def invalidate(self, address: str):
+        """Drop a single address (e.g. after an alias is created)"""
+        self._entries.pop(address, None)
+    
+    def clear(self):
+        """Drop every cached route"""
+        self._entries.clear()
+
+
+def notify_routing_change():
+    """
+    Invalidate routing caches after domain or alias changes
+    
+    Clears this process's cache and touches the marker file so the
+    running service picks up changes made from another process.
+    """
+    routing_cache.clear()
+    
+    Path(ROUTING_INVALIDATION_FILE).touch()
+
+
+# Process-wide routing cache used by the ingest pipeline
+routing_cache = RoutingCache(
+    ttl=ROUTING_CACHE_TTL,
+    negative_ttl=ROUTING_CACHE_NEGATIVE_TTL,
+    max_entries=ROUTING_CACHE_MAX_ENTRIES,
+    marker_path=ROUTING_INVALIDATION_FILE,
+)
@@ -0,0 +1,30 @@
+"""
+Ingest package initialization
+Durable spooling and processing of inbound emails
+"""
+
+from .spool import EmailSpool
+from .parsing import ParsedEmail, EmailHeaders, EmailParser, parse_email, parse_headers, parse_recipients
+from .body import PayloadTooLarge, UnsupportedEncoding, read_body
+from .batch import BATCH_CONTENT_TYPE, encode_batch, decode_batch, iter_frames
+from .pipeline import process_email, process_batch, IngestWorkers
+
+__all__ = [
+    'EmailSpool',
+    'ParsedEmail',
+    'EmailHeaders',
+    'EmailParser',
+    'parse_email',
+    'parse_headers',
+    'parse_recipients',
+    'PayloadTooLarge',
+    'UnsupportedEncoding',
+    'read_body',
+    'BATCH_CONTENT_TYPE',
+    'encode_batch',
+    'decode_batch',
+    'iter_frames',
+    'process_email',
+    'process_batch',
+    'IngestWorkers',
+]
@@ -0,0 +1,92 @@
+"""
+Email Batch Framing
+Length-prefixed container for several raw MIME messages in one request
+
+Format: repeated [4-byte big-endian length][message bytes]
+"""
+
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+import struct
+
+_LENGTH = struct.Struct(">I")
+
+BATCH_CONTENT_TYPE = "application/x-email-batch"
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def encode_batch(bodies: Iterable[bytes]) -> bytes:
+    """Frame raw messages into a single batch payload"""
+    return b"".join(_LENGTH.pack(len(body)) + body for body in bodies)
+
+
+def decode_batch(data: bytes, max_messages: int = 0) -> List[bytes]:
+    """
+    Split a batch payload into raw messages
+    
+    Raises:
+        ValueError: if the framing is truncated or exceeds max_messages
+    """
+    bodies = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        if offset + _LENGTH.size > len(data):
+            raise ValueError(f"Truncated length prefix at byte {offset}")
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        
+        if offset + length > len(data):
+            raise ValueError(f"Message {len(bodies)} is truncated ({length} bytes declared)")
+        bodies.append(bytes(view[offset:offset + length]))
+        offset += length
+        
+        if max_messages and len(bodies) > max_messages:
+            raise ValueError(f"Batch exceeds {max_messages} messages")
+    return bodies
+
+
+def iter_frames(f: BinaryIO, max_messages: int = 0, head_bytes: int = 0) -> Iterator[Tuple[int, int, bytes]]:
+    """
+    Walk the frames of a seekable batch file one message at a time
+    
+    Yields (offset, length, head) per message, where offset is where the
+    message starts and head holds at most its first head_bytes bytes.
+    Message bodies are skipped, not read.
+    
+    Raises:
+        ValueError: if the framing is truncated or exceeds max_messages
+    """
+    size = f.seek(0, 2)
+    offset = 0
+    count = 0
+    while offset < size:
+        f.seek(offset)
+        prefix = f.read(_LENGTH.size)
+        if len(prefix) < _LENGTH.size:
+            raise ValueError(f"Truncated length prefix at byte {offset}")
+        (length,) = _LENGTH.unpack(prefix)
+        offset += _LENGTH.size
+        
+        if offset + length > size:
+            raise ValueError(f"Message {count} is truncated ({length} bytes declared)")
+        count += 1
+        if max_messages and count > max_messages:
+            raise ValueError(f"Batch exceeds {max_messages} messages")
+        
+        yield offset, length, f.read(min(length, head_bytes))
+        offset += length
+
+
+def write_frames(source: BinaryIO, frames: Iterable[Tuple[int, int]], dest: BinaryIO):
+    """Copy (offset, length) messages of a batch file into dest as a new batch, in chunks"""
+    for offset, length in frames:
+        dest.write(_LENGTH.pack(length))
+        source.seek(offset)
+        remaining = length
+        while remaining:
+            chunk = source.read(min(remaining, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise ValueError(f"Batch source ended {remaining} bytes early")
+            dest.write(chunk)
+            remaining -= len(chunk)
@@ -0,0 +1,83 @@
+"""
+Request Body Streaming
+Streams webhook bodies into a spooled temporary file (memory below a
+threshold, disk above it) with a size limit and gzip support
+"""
+
+from tempfile import SpooledTemporaryFile
+from typing import AsyncIterator, Optional
+import zlib
+
+
+class PayloadTooLarge(Exception):
+    """Raised when a body exceeds the configured maximum size"""
+    pass
+
+
+class UnsupportedEncoding(Exception):
+    """Raised for a Content-Encoding we can't decode"""
+    pass
+
+
+async def read_body(chunks: AsyncIterator[bytes], max_bytes: int, memory_threshold: int,
+                    content_encoding: Optional[str] = None) -> SpooledTemporaryFile:
+    """
+    Stream a request body into a SpooledTemporaryFile
+    
+    The size limit applies to the decoded body, so a small gzip payload
+    can't expand past max_bytes.
+    
+    Args:
+        chunks: Async iterator of raw body chunks (e.g. request.stream())
+        max_bytes: Maximum decoded size
+        memory_threshold: Bodies larger than this are rolled over to disk
+        content_encoding: Value of the Content-Encoding header
+    
+    Returns:
+        File positioned at the start of the decoded body
+    
+    Raises:
+        PayloadTooLarge: if the decoded body exceeds max_bytes
+        UnsupportedEncoding: for encodings other than identity/gzip
+        zlib.error: if the gzip stream is corrupt
+    """
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "identity":
+        decoder = None
+    else:
+        raise UnsupportedEncoding(encoding)
+    
+    spooled = SpooledTemporaryFile(max_size=memory_threshold)
+    size = 0
+    
+    def write(data: bytes):
+        nonlocal size
+        size += len(data)
+        if size > max_bytes:
+            raise PayloadTooLarge(f"Body exceeds {max_bytes} bytes")
+        spooled.write(data)
+    
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            if decoder is None:
+                write(chunk)
+                continue
+            
+            # Bound each decompression step so a bomb can't allocate past the limit
+            data = decoder.decompress(chunk, max_bytes - size + 1)
+            write(data)
+            while decoder.unconsumed_tail:
+                write(decoder.decompress(decoder.unconsumed_tail, max_bytes - size + 1))
+        
+        if decoder is not None:
+            write(decoder.flush())
+    except BaseException:
+        spooled.close()
+        raise
+    
+    spooled.seek(0)
+    return spooled
@@ -0,0 +1,262 @@
+"""
+Email Parsing
+Converts raw MIME bytes into a compact, picklable structure,
+optionally on a process pool so large messages don't block the event loop
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from pathlib import Path
+from typing import List, Optional
+import asyncio
+import binascii
+import hashlib
+import logging
+import os
+import uuid
+
+import mailparser
+
+from config import ATTACHMENT_DIR
+
+logger = logging.getLogger(__name__)
+
+# Headers that may carry a recipient, in order of preference
+RECIPIENT_HEADERS = ("Delivered-To", "X-Original-To", "To", "Cc")
+
+# Upper bound on how far we look for the end of the header block
+HEADER_SCAN_BYTES = 65536
+
+# Base64 characters decoded per step when writing attachments to disk
+DECODE_CHUNK_CHARS = 256 * 1024
+
+_header_parser = BytesHeaderParser()
+
+
+@dataclass
+class ParsedEmail:
+    """Parsed email fields needed for logging and delivery"""
+    sender: str
+    subject: Optional[str]
+    body_html: str
+    body_plain: str
+    date: str
+    attachments: List[dict] = field(default_factory=list)  # filename, content_type, path, size, sha256
+    
+    def move_attachments(self, directory: str):
+        """Move the decoded attachment files into another directory (e.g. the outbox)"""
+        target = Path(directory)
+        target.mkdir(parents=True, exist_ok=True)
+        for attachment in self.attachments:
+            new_path = target / Path(attachment['path']).name
+            os.replace(attachment['path'], new_path)
+            attachment['path'] = str(new_path)
+    
+    def cleanup(self):
+        """Delete the decoded attachment files"""
+        for attachment in self.attachments:
+            Path(attachment['path']).unlink(missing_ok=True)
+
+
+def _address(entry) -> Optional[str]:
+    return entry[1] if isinstance(entry, tuple) else entry
+
+
+def _raw_addresses(value) -> List[str]:
+    if isinstance(value, list):
+        entries = [_address(entry) for entry in value]
+    elif isinstance(value, str):
+        entries = [value]
+    else:
+        entries = []
+    return [entry for entry in entries if entry]
+
+
+def _header_block(body: bytes) -> bytes:
+    prefix = body[:HEADER_SCAN_BYTES]
+    ends = [idx for idx in (prefix.find(b"\r\n\r\n"), prefix.find(b"\n\n")) if idx != -1]
+    return prefix[:min(ends)] if ends else prefix
+
+
+@dataclass
+class EmailHeaders:
+    """Fields resolved from the header block alone"""
+    recipients: List[str]
+    message_id: Optional[str]
+
+
+def parse_headers(body: bytes) -> EmailHeaders:
+    """
+    Parse only the header block of a raw message
+    
+    Cheap first stage used to reject unregistered recipients and
+    duplicate deliveries before the full MIME parse. Recipients are
+    unique lowercase addresses from Delivered-To, X-Original-To, To
+    and Cc, in that order.
+    """
+    headers = _header_parser.parsebytes(_header_block(body))
+    
+    recipients = []
+    for name in RECIPIENT_HEADERS:
+        values = [str(value) for value in headers.get_all(name, [])]
+        for _, address in getaddresses(values):
+            address = address.lower().strip()
+            if address and address not in recipients:
+                recipients.append(address)
+    
+    message_id = headers.get("Message-ID")
+    return EmailHeaders(
+        recipients=recipients,
+        message_id=str(message_id).strip() if message_id else None,
+    )
+
+
+def parse_recipients(body: bytes) -> List[str]:
+    """Resolve recipient addresses from the header block only"""
+    return parse_headers(body).recipients
+
+
+def _write_base64(payload: str, f):
+    # Decode in bounded steps, carrying partial 4-character groups over
+    pending = ""
+    for start in range(0, len(payload), DECODE_CHUNK_CHARS):
+        pending += "".join(payload[start:start + DECODE_CHUNK_CHARS].split())
+        usable = len(pending) - len(pending) % 4
+        f.write(binascii.a2b_base64(pending[:usable]))
+        pending = pending[usable:]
+    if pending:
+        f.write(binascii.a2b_base64(pending + "=" * (-len(pending) % 4)))
+
+
+class _HashingWriter:
+    """File wrapper that hashes everything written through it"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+    
+    def write(self, data: bytes):
+        self.sha256.update(data)
+        self.f.write(data)
+
+
+def _save_attachment(attachment: dict) -> dict:
+    """Decode one attachment straight to a file and describe it"""
+    payload = attachment.get('payload') or ""
+    directory = Path(ATTACHMENT_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / uuid.uuid4().hex
+    
+    with open(path, "wb") as f:
+        # The content hash lets repeated attachments reuse a Telegram file_id
+        writer = _HashingWriter(f)
+        if isinstance(payload, bytes):
+            writer.write(payload)
+        elif attachment.get('binary'):
+            _write_base64(payload, writer)
+        else:
+            writer.write(payload.encode(attachment.get('charset') or 'utf-8', errors='replace'))
+        size = f.tell()
+    
+    return {
+        'filename': attachment.get('filename') or 'unnamed',
+        'content_type': attachment.get('mail_content_type', 'application/octet-stream'),
+        'path': str(path),
+        'size': size,
+        'sha256': writer.sha256.hexdigest()
+    }
+
+
+def clear_attachment_dir():
+    """Remove attachment files left behind by an unclean shutdown"""
+    directory = Path(ATTACHMENT_DIR)
+    if directory.exists():
+        for leftover in directory.iterdir():
+            leftover.unlink(missing_ok=True)
+
+
+def parse_email(body: bytes) -> ParsedEmail:
+    """
+    Parse a raw MIME message
+    
+    Module-level so it can run inside a ProcessPoolExecutor. Attachments
+    are decoded once to files in ATTACHMENT_DIR and described by path, so
+    the result stays small; call ParsedEmail.cleanup() when done.
+    """
+    mail = mailparser.parse_from_bytes(body)
+    
+    # Extract sender
+    senders = _raw_addresses(mail.from_)
+    sender_email = senders[0] if senders else "Unknown"
+    
+    # Prepare email body (handle both string and list)
+    body_html = mail.text_html
+    if isinstance(body_html, list):
+        body_html = '\n'.join(body_html) if body_html else ""
+    elif body_html is None:
+        body_html = mail.text_plain or ""
+    
+    if isinstance(body_html, list):
+        body_html = '\n'.join(str(item) for item in body_html)
+    
+    body_html = str(body_html) if body_html else ""
+    
+    body_plain = mail.text_plain
+    if isinstance(body_plain, list):
+        body_plain = '\n'.join(str(item) for item in body_plain) if body_plain else ""
+    elif body_plain is None:
+        body_plain = body_html or "No content"
+    
+    body_plain = str(body_plain) if body_plain else "No content"
+    
+    # Decode attachments to disk, releasing each encoded payload as we go
+    attachments = []
+    for attachment in mail.attachments or []:
+        attachments.append(_save_attachment(attachment))
+        attachment['payload'] = None
+    
+    return ParsedEmail(
+        sender=sender_email,
+        subject=mail.subject,
+        body_html=body_html,
+        body_plain=body_plain,
+        date=str(mail.date) if mail.date else "Unknown",
+        attachments=attachments,
+    )
+
+
+class EmailParser:
+    """
+    Parses emails inline or on a process pool
+    
+    Messages smaller than inline_max_bytes are parsed directly on the
+    event loop (pickling overhead would dominate); larger ones are sent
+    to the process pool when one is configured.
+    """
+    
+    def __init__(self, workers: int = 0, inline_max_bytes: int = 65536):
+        self.workers = workers
+        self.inline_max_bytes = inline_max_bytes
+        self._executor: Optional[ProcessPoolExecutor] = None
+    
+    def start(self):
+        """Start the process pool (no-op when workers is 0)"""
+        if self.workers > 0:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            logger.info(f"✅ Started email parsing pool with {self.workers} process(es)")
+    
+    def shutdown(self):
+        """Stop the process pool"""
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+    
+    async def parse(self, body: bytes) -> ParsedEmail:
+        """Parse a raw message, offloading large ones to the pool"""
+        if self._executor is None or len(body) <= self.inline_max_bytes:
+            return parse_email(body)
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, parse_email, body)
@@ -0,0 +1,501 @@
+"""
+Email Processing Pipeline
+Parses spooled emails, logs them and queues Telegram notifications
+"""
+
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import logging
+import random
+
+from sqlalchemy import insert
+from sqlalchemy.exc import InterfaceError, OperationalError, TimeoutError as SQLAlchemyTimeoutError
+
+from bot.bot import render_email_notification, bind_email_log, call_files, PENDING_LOG_ID
+from bot.digest import add_to_digest, digest_call
+from bot.outbox import enqueue_calls, outbox_dispatcher
+from config import OUTBOX_DIR
+from database import (
+    AsyncSessionLocal, EmailLog, routing_cache, dedup_store, make_dedup_key, attachment_store
+)
+from ingest.parsing import EmailParser, ParsedEmail, parse_email, parse_headers, clear_attachment_dir
+from ingest.batch import decode_batch, write_frames
+from ingest.spool import EmailSpool, BATCH_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+# Failures that clear up on their own (database locked or unreachable, pool
+# exhausted, disk full): the spooled item is kept and retried, while any
+# other error means the mail itself cannot be processed
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, SQLAlchemyTimeoutError, OSError, asyncio.TimeoutError)
+
+
+async def resolve_deliveries(recipients: List[str]) -> Dict[int, str]:
+    """
+    Map each distinct Telegram user to the first recipient alias they own
+    
+    All recipients are resolved at once through the routing cache
+    (cache misses are loaded with a single IN query).
+    """
+    routes = await routing_cache.resolve(recipients)
+    
+    deliveries = {}
+    for address in recipients:
+        route = routes.get(address)
+        if not route:
+            continue
+        if not route.domain_active:
+            logger.warning(f"Domain for '{address}' is inactive - skipping")
+            continue
+        # A user addressed through several aliases gets the email once
+        deliveries.setdefault(route.telegram_id, address)
+    return deliveries
+
+
+def build_email_data(mail: ParsedEmail, recipient_email: str) -> dict:
+    """Build the notification payload for one recipient"""
+    return {
+        'from': mail.sender,
+        'to': recipient_email,
+        'subject': mail.subject or "No Subject",
+        'body_plain': mail.body_plain,
+        'body_html': mail.body_html,  # Add HTML body for better formatting
+        'attachment_count': len(mail.attachments),
+        'attachments': mail.attachments,
+        'date': mail.date
+    }
+
+
+def _duplicate_result(message_id: Optional[str], email_log_ids: List[int]) -> dict:
+    return {
+        "status": "duplicate",
+        "message": "Email already delivered",
+        "email_info": {
+            "message_id": message_id,
+            "email_log_ids": email_log_ids
+        }
+    }
+
+
+class _PendingEmail:
+    """Per-message state while a batch moves through the pipeline"""
+    
+    def __init__(self, body: bytes):
+        self.body = body
+        self.headers = parse_headers(body)
+        self.deliveries: Dict[int, str] = {}
+        self.digest_windows: Dict[int, int] = {}
+        self.uploads_queued = False
+        self.dedup_keys: Dict[int, str] = {}
+        self.mail: Optional[ParsedEmail] = None
+        self.log_ids: List[int] = []
+        # Rendered notification per instant (non-digest) recipient
+        self.calls: Dict[int, List[dict]] = {}
+        self.result: Optional[dict] = None
+    
+    @property
+    def label(self) -> str:
+        return self.headers.message_id or "(no Message-ID)"
+
+
+async def _route(item: _PendingEmail):
+    """Stage 1 for one message: recipients and routing"""
+    recipients = item.headers.recipients
+    if not recipients:
+        logger.error("No recipient email found in the message")
+        item.result = {"status": "error", "message": "No recipient email found"}
+        return
+    
+    logger.info(f"Recipient candidates: {', '.join(recipients)}")
+    
+    item.deliveries = await resolve_deliveries(recipients)
+    if not item.deliveries:
+        # Spam to unknown addresses never reaches the full MIME parse
+        logger.warning(f"No registered recipient among: {', '.join(recipients)}")
+        item.result = {
+            "status": "error",
+            "message": f"Email address '{recipients[0]}' not registered"
+        }
+        return
+    
+    # Recipients whose alias is in digest mode (routes are cached by now)
+    routes = await routing_cache.resolve(item.deliveries.values())
+    item.digest_windows = {
+        telegram_id: routes[recipient_email].digest_window
+        for telegram_id, recipient_email in item.deliveries.items()
+        if recipient_email in routes and routes[recipient_email].digest_window
+    }
+    
+    item.dedup_keys = {
+        telegram_id: make_dedup_key(item.headers.message_id, item.body, recipient_email)
+        for telegram_id, recipient_email in item.deliveries.items()
+    }
+
+
+def _drop_duplicates(item: _PendingEmail, seen: Dict[str, Optional[int]]):
+    """
+    Drop recipients that already received this message (webhook retries)
+    
+    Keys kept for delivery are added to seen (without a log ID yet), so a
+    message repeated within the same batch is only delivered once.
+    """
+    duplicate_keys = [key for key in item.dedup_keys.values() if key in seen]
+    if duplicate_keys:
+        duplicate_log_ids = [seen[key] for key in duplicate_keys if seen[key] is not None]
+        item.deliveries = {
+            telegram_id: recipient_email
+            for telegram_id, recipient_email in item.deliveries.items()
+            if item.dedup_keys[telegram_id] not in seen
+        }
+        if not item.deliveries:
+            logger.info(f"🔁 Duplicate email {item.label} - already delivered")
+            item.result = _duplicate_result(item.headers.message_id, duplicate_log_ids)
+            return
+    
+    for telegram_id, recipient_email in item.deliveries.items():
+        seen[item.dedup_keys[telegram_id]] = None
+        logger.info(f"Recipient: {recipient_email} (Telegram ID: {telegram_id})")
+
+
+async def _parse(item: _PendingEmail, parser: Optional[EmailParser]):
+    """Stage 2: full parse, once for all recipients (off the event loop for large messages)"""
+    if parser:
+        item.mail = await parser.parse(item.body)
+    else:
+        item.mail = parse_email(item.body)
+    
+    logger.info(f"Sender: {item.mail.sender}")
+    logger.info(f"Subject: {item.mail.subject}")
+
+
+async def _render(item: _PendingEmail):
+    """
+    Stage 3: render the notification of every instant recipient and store
+    the attachments of emails that are only sent on demand
+    
+    Summaries are rendered with PENDING_LOG_ID; their buttons are bound to
+    the email log once its row has been inserted.
+    """
+    deferred = False
+    for telegram_id, recipient_email in item.deliveries.items():
+        if telegram_id in item.digest_windows:
+            deferred = True
+            continue
+        calls = render_email_notification(
+            build_email_data(item.mail, recipient_email), PENDING_LOG_ID, document_dir=OUTBOX_DIR
+        )
+        item.calls[telegram_id] = calls
+        if any(call_files(call) for call in calls):
+            item.uploads_queued = True
+        else:
+            deferred = True
+    
+    # Emails expanded later keep their attachments in the store
+    if deferred:
+        await attachment_store.keep(item.mail.attachments)
+
+
+class _ConcurrentDelivery(Exception):
+    """Another transaction recorded one of the batch's idempotency keys first"""
+
+
+def _queued_result(item: _PendingEmail) -> dict:
+    mail = item.mail
+    return {
+        "status": "success",
+        "message": "Email received and queued for delivery",
+        "email_info": {
+            "from": mail.sender,
+            "to": list(item.deliveries.values()),
+            "subject": mail.subject,
+            "delivered_to_telegram": list(item.deliveries.keys())
+        }
+    }
+
+
+async def process_batch(bodies: List[bytes], parser: Optional[EmailParser] = None) -> List[dict]:
+    """
+    Process several raw MIME emails through the pipeline together
+    
+    Recipients of all messages are routed with one lookup, duplicates
+    are checked with one query, and all EmailLog and outbox rows are
+    written in a single transaction with bulk inserts. Telegram delivery
+    happens afterwards in the outbox dispatcher, so ingest never waits
+    on the Bot API.
+    
+    Args:
+        bodies: Raw MIME message bytes
+        parser: Optional EmailParser (process pool); parses inline if omitted
+    
+    Returns:
+        One result dictionary per message, in input order
+    """
+    logger.info("="*80)
+    logger.info(f"📧 NEW EMAIL{'S' if len(bodies) > 1 else ''} RECEIVED ({len(bodies)})")
+    logger.info("="*80)
+    
+    # Stage 1: header block only - route every recipient of every message at once
+    items = [_PendingEmail(body) for body in bodies]
+    await routing_cache.resolve(
+        {address for item in items for address in item.headers.recipients}
+    )
+    
+    for item in items:
+        await _route(item)
+    
+    # One query covers the duplicate check for the whole batch
+    routed = [item for item in items if item.result is None]
+    seen = await dedup_store.seen(
+        [key for item in routed for key in item.dedup_keys.values()]
+    )
+    for item in routed:
+        _drop_duplicates(item, seen)
+    
+    deliverable = [item for item in items if item.result is None]
+    if not deliverable:
+        return [item.result for item in items]
+    
+    committed = False
+    try:
+        await asyncio.gather(*(_parse(item, parser) for item in deliverable))
+        
+        # Attachment files are uploaded by the outbox dispatcher from now on
+        for item in deliverable:
+            item.mail.move_attachments(OUTBOX_DIR)
+        
+        # Rendering (HTML conversion, body documents) and attachment copies
+        # happen before the transaction, which on SQLite holds the write lock
+        for item in deliverable:
+            await _render(item)
+        
+        async with AsyncSessionLocal() as session:
+            # Store one log row per recipient in a single bulk insert
+            now = datetime.utcnow()
+            rows = [
+                (item, telegram_id, {
+                    "user_id": telegram_id,
+                    "sender": item.mail.sender,
+                    "receiver": recipient_email,
+                    "subject": item.mail.subject or "No Subject",
+                    "body_html": item.mail.body_html,
+                    "body_plain": item.mail.body_plain,
+                    "timestamp": now,
+                })
+                for item in deliverable
+                for telegram_id, recipient_email in item.deliveries.items()
+            ]
+            result = await session.scalars(
+                insert(EmailLog).returning(EmailLog.id, sort_by_parameter_order=True),
+                [values for _, _, values in rows]
+            )
+            
+            # Record idempotency keys in the same transaction as the logs
+            processed = {}
+            for (item, telegram_id, _), log_id in zip(rows, result.all()):
+                item.log_ids.append(log_id)
+                processed[item.dedup_keys[telegram_id]] = log_id
+            overlapped = await dedup_store.record(session, processed)
+            if overlapped:
+                # A concurrent worker delivered some of these messages first
+                await session.rollback()
+                raise _ConcurrentDelivery()
+            
+            # Queue the rendered notifications (or digest entries) in the same transaction
+            for item in deliverable:
+                deferred_log_ids = []
+                for (telegram_id, recipient_email), log_id in zip(item.deliveries.items(), item.log_ids):
+                    window = item.digest_windows.get(telegram_id)
+                    if window:
+                        deferred_log_ids.append(log_id)
+                        if await add_to_digest(session, telegram_id, recipient_email, log_id):
+                            await enqueue_calls(session, telegram_id, [digest_call(recipient_email)], delay=window)
+                        continue
+                    calls = bind_email_log(item.calls[telegram_id], log_id)
+                    if not any(call_files(call) for call in calls):
+                        # Summary notification: the full email is sent on demand
+                        deferred_log_ids.append(log_id)
+                    await enqueue_calls(session, telegram_id, calls, log_id)
+                
+                # Emails expanded later keep their attachments in the store
+                await attachment_store.save(session, deferred_log_ids, item.mail.attachments)
+            
+            await session.commit()
+            committed = True
+            dedup_store.remember_committed(processed)
+            
+            for item in deliverable:
+                logger.info(f"Email logged to database (IDs: {', '.join(map(str, item.log_ids))})")
+                item.result = _queued_result(item)
+    except _ConcurrentDelivery:
+        pass
+    finally:
+        # Attachments were decoded to disk during parsing; once committed
+        # they belong to the outbox rows (deferred emails have a stored copy)
+        for item in deliverable:
+            if item.mail and not (committed and item.uploads_queued):
+                item.mail.cleanup()
+            if not committed:
+                for calls in item.calls.values():
+                    for path in (path for call in calls for path in call_files(call)):
+                        Path(path).unlink(missing_ok=True)
+    
+    if not committed:
+        # The rerun sees the concurrent keys and only drops those recipients
+        logger.info("Batch overlapped with a concurrent delivery - checking duplicates again")
+        return await process_batch(bodies, parser)
+    
+    outbox_dispatcher.wake()
+    
+    logger.info("="*80)
+    logger.info("✅ EMAIL PROCESSING COMPLETE")
+    logger.info("="*80)
+    
+    return [item.result for item in items]
+
+
+async def process_email(body: bytes, parser: Optional[EmailParser] = None) -> dict:
+    """
+    Parse a raw MIME email, store it and queue it for every recipient's Telegram
+    
+    Args:
+        body: Raw MIME message bytes
+        parser: Optional EmailParser (process pool); parses inline if omitted
+    
+    Returns:
+        Result dictionary with status, message and email info
+    """
+    results = await process_batch([body], parser)
+    return results[0]
+
+
+class IngestWorkers:
+    """
+    Pool of asyncio workers draining the email spool
+    
+    The webhook only appends to the spool and enqueues the spool ID;
+    workers do the parsing and database writes, and queue Telegram
+    delivery in the outbox.
+    """
+    
+    def __init__(self, spool: EmailSpool, worker_count: int = 4,
+                 parser: Optional[EmailParser] = None,
+                 retry_base_delay: float = 5, retry_max_delay: float = 300):
+        self.spool = spool
+        self.parser = parser
+        self.worker_count = max(1, worker_count)
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._tasks = []
+        self._attempts: Dict[str, int] = {}
+        self._retries: Dict[str, asyncio.TimerHandle] = {}
+    
+    async def start(self):
+        """Replay unfinished spool items and start the workers"""
+        self.spool.setup()
+        clear_attachment_dir()
+        
+        replayed = self.spool.pending()
+        for item_id in replayed:
+            self.queue.put_nowait(item_id)
+        if replayed:
+            logger.info(f"Replaying {len(replayed)} unfinished spooled email(s)")
+        
+        for _ in range(self.worker_count):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        logger.info(f"✅ Started {self.worker_count} ingest worker(s)")
+    
+    async def stop(self):
+        """Cancel workers; unfinished items stay spooled for the next start"""
+        for handle in self._retries.values():
+            handle.cancel()
+        self._retries.clear()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+    
+    async def submit(self, body) -> str:
+        """Durably spool a raw email (bytes or binary file) and queue it for processing"""
+        item_id = await self.spool.put(body)
+        self.queue.put_nowait(item_id)
+        return item_id
+    
+    async def submit_batch(self, source, frames: List[Tuple[int, int]]) -> str:
+        """
+        Durably spool several raw emails as one item, processed together
+        
+        frames are (offset, length) messages in the batch file source (see
+        iter_frames); they are copied in chunks rather than loaded whole.
+        """
+        item_id = await self.spool.put(partial(write_frames, source, frames), BATCH_SUFFIX)
+        self.queue.put_nowait(item_id)
+        return item_id
+    
+    @property
+    def depth(self) -> int:
+        """Number of spooled emails waiting for a worker"""
+        return self.queue.qsize()
+    
+    async def _worker(self):
+        while True:
+            item_id = await self.queue.get()
+            try:
+                await self._process(item_id)
+            finally:
+                self.queue.task_done()
+    
+    async def _process(self, item_id: str):
+        try:
+            body = await self.spool.read(item_id)
+        except FileNotFoundError:
+            logger.warning(f"Spooled email {item_id} disappeared before processing")
+            self._attempts.pop(item_id, None)
+            return
+        except OSError as e:
+            self._schedule_retry(item_id, e)
+            return
+        
+        try:
+            if item_id.endswith(BATCH_SUFFIX):
+                results = await process_batch(decode_batch(body), self.parser)
+            else:
+                results = [await process_email(body, self.parser)]
+        except asyncio.CancelledError:
+            # Leave the item in pending/ so it is replayed on restart
+            raise
+        except TRANSIENT_ERRORS as e:
+            self._schedule_retry(item_id, e)
+            return
+        except Exception as e:
+            logger.error(f"❌ ERROR PROCESSING EMAIL {item_id}: {str(e)}")
+            logger.error(f"Error Type: {type(e).__name__}")
+            import traceback
+            traceback.print_exc()
+            self._attempts.pop(item_id, None)
+            self.spool.fail(item_id)
+            return
+        
+        self._attempts.pop(item_id, None)
+        self.spool.complete(item_id)
+        statuses = ", ".join(result.get('status') for result in results)
+        logger.info(f"Spooled email {item_id} finished: {statuses}")
+    
+    def _schedule_retry(self, item_id: str, error: Exception):
+        """Queue the item again after a jittered exponential backoff (it stays in pending/)"""
+        attempts = self._attempts.get(item_id, 0) + 1
+        self._attempts[item_id] = attempts
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempts))
+        logger.warning(
+            f"⚠️ Spooled email {item_id} hit a transient error (attempt {attempts}): "
+            f"{type(error).__name__}: {error} - retrying in {delay:.1f}s"
+        )
+        
+        def requeue():
+            self._retries.pop(item_id, None)
+            self.queue.put_nowait(item_id)
+        
+        self._retries[item_id] = asyncio.get_running_loop().call_later(delay, requeue)
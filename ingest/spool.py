@@ -0,0 +1,137 @@
+"""
+Email Spool
+File-backed durable queue for raw inbound emails
+"""
+
+from pathlib import Path
+from typing import List
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, single process assumed
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Spool items holding a length-prefixed batch of messages
+BATCH_SUFFIX = ".batch"
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class EmailSpool:
+    """
+    Directory-backed spool for raw MIME messages
+    
+    Layout:
+        tmp/      - partially written items (discarded on startup)
+        pending/  - durable items waiting to be processed
+        failed/   - items that raised while processing (kept for inspection)
+    
+    An item is only visible in pending/ once it has been fully written and
+    fsynced, so a crash can never expose a truncated message to the workers.
+    
+    The spool, like the rest of the service, belongs to a single process:
+    startup clears tmp/ and replays every pending item, so lock() takes an
+    exclusive lock on the directory and a second server fails fast instead.
+    """
+    
+    def __init__(self, directory: str):
+        self.root = Path(directory)
+        self.tmp_dir = self.root / "tmp"
+        self.pending_dir = self.root / "pending"
+        self.failed_dir = self.root / "failed"
+        self._lock_file = None
+    
+    def lock(self):
+        """
+        Take the single-process lock on the spool directory
+        
+        Raises:
+            RuntimeError: if another process already holds it
+        """
+        if self._lock_file is not None:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.root / ".lock", "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                raise RuntimeError(
+                    f"Spool {self.root} is in use by another process; "
+                    f"run a single server process (e.g. uvicorn without --workers)"
+                )
+        self._lock_file = lock_file
+    
+    def unlock(self):
+        """Release the single-process lock"""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+    
+    def setup(self):
+        """Create spool directories and drop incomplete writes (takes the lock first)"""
+        self.lock()
+        for path in (self.tmp_dir, self.pending_dir, self.failed_dir):
+            path.mkdir(parents=True, exist_ok=True)
+        
+        for leftover in self.tmp_dir.iterdir():
+            leftover.unlink(missing_ok=True)
+    
+    def _write(self, source, suffix: str = "") -> str:
+        # Time prefix keeps replay roughly in arrival order
+        item_id = f"{time.time_ns():020d}-{uuid.uuid4().hex}{suffix}"
+        tmp_path = self.tmp_dir / item_id
+        
+        try:
+            with open(tmp_path, "wb") as f:
+                if isinstance(source, (bytes, bytearray, memoryview)):
+                    f.write(source)
+                elif callable(source):
+                    source(f)
+                else:
+                    shutil.copyfileobj(source, f, COPY_CHUNK_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        
+        os.replace(tmp_path, self.pending_dir / item_id)
+        return item_id
+    
+    async def put(self, body, suffix: str = "") -> str:
+        """
+        Durably store a raw message and return its spool ID
+        
+        body may be bytes, a readable binary file (copied in chunks) or a
+        callable that writes the item into the file it is given.
+        The suffix marks the item kind (e.g. BATCH_SUFFIX for framed batches).
+        """
+        return await asyncio.to_thread(self._write, body, suffix)
+    
+    async def read(self, item_id: str) -> bytes:
+        """Read a spooled message"""
+        return await asyncio.to_thread((self.pending_dir / item_id).read_bytes)
+    
+    def complete(self, item_id: str):
+        """Remove a message once it has been fully processed"""
+        (self.pending_dir / item_id).unlink(missing_ok=True)
+    
+    def fail(self, item_id: str):
+        """Move a message that could not be processed out of the queue"""
+        source = self.pending_dir / item_id
+        if source.exists():
+            os.replace(source, self.failed_dir / item_id)
+    
+    def pending(self) -> List[str]:
+        """List unfinished items in arrival order (used for replay)"""
+        return sorted(p.name for p in self.pending_dir.iterdir() if p.is_file())
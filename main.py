@@ -1,14 +1,28 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
-import mailparser
+from fastapi.responses import JSONResponse, Response
 from datetime import datetime
 import asyncio
+import hmac
 import logging
+import zlib
 from contextlib import asynccontextmanager
 
-from bot import create_bot_application, send_email_notification
-from config import FASTAPI_HOST, FASTAPI_PORT
-from database import init_db
+from telegram import Update
+
+from bot import create_bot_application, bot_clients, delivery_scheduler, outbox_dispatcher
+from config import (
+    FASTAPI_HOST, FASTAPI_PORT, SPOOL_DIR, INGEST_WORKERS,
+    INGEST_RETRY_BASE_DELAY, INGEST_RETRY_MAX_DELAY,
+    TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_PATH, TELEGRAM_WEBHOOK_SECRET,
+    PARSE_WORKERS, PARSE_INLINE_MAX_BYTES, BATCH_MAX_MESSAGES,
+    MAX_EMAIL_BYTES, MAX_BATCH_BYTES, BODY_MEMORY_THRESHOLD
+)
+from database import init_db, routing_cache, address_filter, dedup_store, attachment_store
+from ingest import (
+    EmailSpool, EmailParser, IngestWorkers, parse_recipients, iter_frames,
+    read_body, PayloadTooLarge, UnsupportedEncoding
+)
+from ingest.parsing import HEADER_SCAN_BYTES
 
 # Configure logging
 logging.basicConfig(
@@ -20,30 +34,89 @@ logger = logging.getLogger(__name__)
 # Global bot application instance
 bot_app = None
 
+# Global ingest worker pool (drains the email spool)
+ingest_workers = None
+
+# Global email parser (optional process pool)
+email_parser = None
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     Lifespan context manager to start/stop Telegram bot with FastAPI
     """
-    global bot_app
+    global bot_app, ingest_workers, email_parser
+    
+    # Spool, attachment dir, caches and conversation state are per process:
+    # refuse to start next to another server before touching anything shared
+    spool = EmailSpool(SPOOL_DIR)
+    spool.lock()
+    
+    if TELEGRAM_WEBHOOK_URL and not TELEGRAM_WEBHOOK_SECRET:
+        raise RuntimeError("TELEGRAM_WEBHOOK_SECRET is required when TELEGRAM_WEBHOOK_URL is set")
     
     # Startup: Initialize database
     logger.info("Initializing database...")
     await init_db()
     
+    # Startup: Warm the recipient routing cache
+    await routing_cache.warm()
+    
+    # Startup: Load the registered-address bloom filter
+    await address_filter.load()
+    
+    # Startup: Drop expired idempotency keys
+    await dedup_store.purge_expired()
+    
+    # Startup: Drop expired digest attachments
+    await attachment_store.purge_expired()
+    
     # Startup: Initialize and start Telegram bot
     logger.info("Starting Telegram bot...")
     bot_app = create_bot_application()
     await bot_app.initialize()
     await bot_app.start()
     
-    # Start polling in background
-    asyncio.create_task(bot_app.updater.start_polling(drop_pending_updates=True))
-    logger.info("✅ Telegram bot started successfully")
+    if TELEGRAM_WEBHOOK_URL:
+        # Telegram POSTs updates to telegram_webhook()
+        await bot_app.bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"✅ Telegram bot started successfully (webhook: {TELEGRAM_WEBHOOK_URL})")
+    else:
+        # Start polling in background
+        asyncio.create_task(bot_app.updater.start_polling(drop_pending_updates=True))
+        logger.info("✅ Telegram bot started successfully")
+    
+    # Startup: Deliver queued notifications (survives restarts) on their own connection pools
+    await bot_clients.start()
+    await outbox_dispatcher.start(bot_app)
+    
+    # Startup: Start parsing pool
+    email_parser = EmailParser(PARSE_WORKERS, PARSE_INLINE_MAX_BYTES)
+    email_parser.start()
+    
+    # Startup: Start ingest workers (replays unfinished spooled emails)
+    ingest_workers = IngestWorkers(
+        spool, INGEST_WORKERS, email_parser,
+        retry_base_delay=INGEST_RETRY_BASE_DELAY, retry_max_delay=INGEST_RETRY_MAX_DELAY,
+    )
+    await ingest_workers.start()
     
     yield
     
+    # Shutdown: Stop ingest workers (unfinished emails stay spooled)
+    logger.info("Stopping ingest workers...")
+    await ingest_workers.stop()
+    await outbox_dispatcher.stop()
+    await delivery_scheduler.stop()
+    await bot_clients.stop()
+    email_parser.shutdown()
+    await address_filter.save()
+    
     # Shutdown: Stop Telegram bot
     logger.info("Stopping Telegram bot...")
     try:
@@ -61,6 +134,8 @@ async def lifespan(app: FastAPI):
         logger.warning("⚠️ Bot shutdown timed out, forcing exit")
     except Exception as e:
         logger.error(f"Error stopping bot: {e}")
+    
+    spool.unlock()
 
 
 
@@ -75,193 +150,177 @@ async def root():
     return {
         "status": "Email2Telegram Service Running",
         "services": ["FastAPI Webhook", "Telegram Bot"],
+        "ingest_queue_depth": ingest_workers.depth if ingest_workers else 0,
+        "delivery_queue_depth": delivery_scheduler.depth,
+        "outbox_in_flight": outbox_dispatcher.depth,
         "timestamp": datetime.now().isoformat()
     }
 
 
+async def read_request_body(request: Request, max_bytes: int):
+    """
+    Stream the request body into a spooled temporary file
+    
+    Honours Content-Encoding: gzip and rejects bodies over max_bytes.
+    The caller must close the returned file.
+    """
+    try:
+        return await read_body(
+            request.stream(),
+            max_bytes=max_bytes,
+            memory_threshold=BODY_MEMORY_THRESHOLD,
+            content_encoding=request.headers.get("content-encoding"),
+        )
+    except PayloadTooLarge:
+        raise HTTPException(status_code=413, detail=f"Body exceeds {max_bytes} bytes")
+    except UnsupportedEncoding as e:
+        raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {e}")
+    except zlib.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid gzip body: {e}")
+
+
+def precheck_email(body: bytes):
+    """
+    Cheap checks run before an email is spooled
+    
+    body only needs to cover the header block (see HEADER_SCAN_BYTES).
+    Returns an error result for mail that can be dropped immediately,
+    or None if the email should be queued.
+    """
+    if not body:
+        return {"status": "error", "message": "Empty message body"}
+    
+    # Drop dictionary-attack spam before it is spooled (no database access)
+    recipients = parse_recipients(body)
+    if recipients and not address_filter.filter(recipients):
+        logger.info(f"🚫 Dropped email for unknown address '{recipients[0]}'")
+        return {
+            "status": "error",
+            "message": f"Email address '{recipients[0]}' not registered"
+        }
+    
+    return None
+
+
 @app.post("/webhook/email")
 async def receive_email(request: Request):
     """
     Webhook endpoint to receive raw MIME email from Cloudflare Email Worker
+    
+    The message is streamed to a temporary file, durably spooled and
+    acknowledged immediately; ingest workers parse and deliver it in
+    the background.
     """
+    if ingest_workers is None:
+        raise HTTPException(status_code=503, detail="Ingest workers not running")
+    
+    # Stream the raw body (memory below the threshold, disk above it)
+    body_file = await read_request_body(request, MAX_EMAIL_BYTES)
     try:
-        # Get the raw body
-        body = await request.body()
-        
-        logger.info("="*80)
-        logger.info("📧 NEW EMAIL RECEIVED")
-        logger.info("="*80)
-        
-        # Parse the email using mailparser
-        mail = mailparser.parse_from_bytes(body)
-        
-        # Extract recipient email (first 'to' address)
-        recipient_email = None
-        if isinstance(mail.to, list) and len(mail.to) > 0:
-            recipient_email = mail.to[0][1] if isinstance(mail.to[0], tuple) else mail.to[0]
-        elif isinstance(mail.to, str):
-            recipient_email = mail.to
-        
-        if not recipient_email:
-            logger.error("No recipient email found in the message")
-            return JSONResponse(
-                status_code=200,
-                content={"status": "error", "message": "No recipient email found"}
-            )
-        
-        recipient_email = recipient_email.lower().strip()
-        logger.info(f"Recipient: {recipient_email}")
-        
-        # Extract sender
-        sender_email = None
-        if isinstance(mail.from_, list) and len(mail.from_) > 0:
-            sender_email = mail.from_[0][1] if isinstance(mail.from_[0], tuple) else mail.from_[0]
-        elif isinstance(mail.from_, str):
-            sender_email = mail.from_
-        
-        sender_email = sender_email or "Unknown"
-        logger.info(f"Sender: {sender_email}")
-        logger.info(f"Subject: {mail.subject}")
-        
-        # Count attachments and extract them
-        attachments = []
-        if mail.attachments:
-            for attachment in mail.attachments:
-                attachments.append({
-                    'filename': attachment.get('filename', 'unnamed'),
-                    'content_type': attachment.get('mail_content_type', 'application/octet-stream'),
-                    'payload': attachment.get('payload', b''),
-                    'size': len(attachment.get('payload', b''))
-                })
+        size = body_file.seek(0, 2)
+        body_file.seek(0)
         
-        attachment_count = len(attachments)
+        # Only the header block is needed for the pre-spool checks
+        rejected = precheck_email(body_file.read(HEADER_SCAN_BYTES))
+        if rejected:
+            return JSONResponse(status_code=200, content=rejected)
         
-        # Database lookup and notification
-        from database import AsyncSessionLocal, UserEmail, User, EmailLog
-        from sqlalchemy import select
-        from sqlalchemy.orm import selectinload
+        body_file.seek(0)
+        item_id = await ingest_workers.submit(body_file)
+    finally:
+        body_file.close()
+    
+    logger.info(f"📥 Email spooled ({size} bytes, ID: {item_id}, queue depth: {ingest_workers.depth})")
+    
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "accepted",
+            "message": "Email queued for delivery",
+            "spool_id": item_id
+        }
+    )
+
+
+@app.post("/webhook/email/batch")
+async def receive_email_batch(request: Request):
+    """
+    Webhook endpoint to receive several raw MIME emails in one request
+    
+    Body format (Content-Type: application/x-email-batch): repeated
+    [4-byte big-endian length][raw message]. Accepted messages are spooled
+    together as one item and processed with shared lookups and bulk inserts.
+    """
+    if ingest_workers is None:
+        raise HTTPException(status_code=503, detail="Ingest workers not running")
+    
+    # Frames are walked one at a time: only each header block is read here
+    # and accepted messages are copied into the spool in chunks
+    body_file = await read_request_body(request, MAX_BATCH_BYTES)
+    try:
+        results = []
+        accepted = []
+        try:
+            for index, (offset, length, head) in enumerate(
+                iter_frames(body_file, BATCH_MAX_MESSAGES, HEADER_SCAN_BYTES)
+            ):
+                rejected = precheck_email(head)
+                if rejected:
+                    results.append({"index": index, **rejected})
+                else:
+                    results.append({"index": index, "status": "accepted"})
+                    accepted.append((offset, length))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid batch: {e}")
         
-        async with AsyncSessionLocal() as session:
-            # Find the user email record
-            result = await session.execute(
-                select(UserEmail)
-                .options(selectinload(UserEmail.user))
-                .where(UserEmail.email_address == recipient_email)
-            )
-            user_email = result.scalar_one_or_none()
-            
-            if not user_email:
-                logger.warning(f"Email address '{recipient_email}' not found in database")
-                return JSONResponse(
-                    status_code=200,
-                    content={
-                        "status": "error",
-                        "message": f"Email address '{recipient_email}' not registered"
-                    }
-                )
-            
-            # Get the user
-            db_user = user_email.user
-            if not db_user:
-                logger.error(f"User not found for email '{recipient_email}'")
-                return JSONResponse(
-                    status_code=200,
-                    content={"status": "error", "message": "User not found"}
-                )
-            
-            telegram_id = db_user.telegram_id
-            logger.info(f"Found user: {db_user.first_name} (Telegram ID: {telegram_id})")
-            
-            # Prepare email body (handle both string and list)
-            body_html = mail.text_html
-            if isinstance(body_html, list):
-                body_html = '\n'.join(body_html) if body_html else ""
-            elif body_html is None:
-                body_html = mail.text_plain or ""
-            
-            if isinstance(body_html, list):
-                body_html = '\n'.join(str(item) for item in body_html)
-            
-            body_html = str(body_html) if body_html else ""
-            
-            # Store email in database
-            email_log = EmailLog(
-                user_id=telegram_id,
-                sender=sender_email,
-                receiver=recipient_email,
-                subject=mail.subject or "No Subject",
-                body_html=body_html,
-                timestamp=datetime.utcnow()
+        item_id = None
+        if accepted:
+            item_id = await ingest_workers.submit_batch(body_file, accepted)
+            logger.info(
+                f"📥 Batch spooled ({len(accepted)}/{len(results)} email(s), ID: {item_id}, "
+                f"queue depth: {ingest_workers.depth})"
             )
-            session.add(email_log)
-            await session.commit()
-            
-            logger.info(f"Email logged to database (ID: {email_log.id})")
-        
-        # Prepare email data for notification
-        body_plain = mail.text_plain
-        if isinstance(body_plain, list):
-            body_plain = '\n'.join(str(item) for item in body_plain) if body_plain else ""
-        elif body_plain is None:
-            body_plain = body_html or "No content"
-        
-        body_plain = str(body_plain) if body_plain else "No content"
-        
-        email_data = {
-            'from': sender_email,
-            'to': recipient_email,
-            'subject': mail.subject or "No Subject",
-            'body_plain': body_plain,
-            'body_html': body_html,  # Add HTML body for better formatting
-            'attachment_count': attachment_count,
-            'attachments': attachments,
-            'date': str(mail.date) if mail.date else "Unknown"
+    finally:
+        body_file.close()
+    
+    return JSONResponse(
+        status_code=202 if accepted else 200,
+        content={
+            "status": "accepted" if accepted else "rejected",
+            "spool_id": item_id,
+            "accepted": len(accepted),
+            "results": results
         }
-        
-        # Send Telegram notification
-        if bot_app:
-            try:
-                await send_email_notification(telegram_id, email_data, bot_app)
-                logger.info(f"✅ Telegram notification sent to user {telegram_id}")
-            except Exception as e:
-                logger.error(f"Failed to send Telegram notification: {e}")
-        else:
-            logger.warning("Bot application not available - notification not sent")
-        
-        logger.info("="*80)
-        logger.info("✅ EMAIL PROCESSING COMPLETE")
-        logger.info("="*80)
-        
-        # Return success response to Cloudflare
-        return JSONResponse(
-            status_code=200,
-            content={
-                "status": "success",
-                "message": "Email received and delivered",
-                "email_info": {
-                    "from": sender_email,
-                    "to": recipient_email,
-                    "subject": mail.subject,
-                    "delivered_to_telegram": telegram_id
-                }
-            }
-        )
-        
-    except Exception as e:
-        logger.error(f"❌ ERROR PROCESSING EMAIL: {str(e)}")
-        logger.error(f"Error Type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
-        
-        # Still return 200 to Cloudflare to avoid retries
-        return JSONResponse(
-            status_code=200,
-            content={
-                "status": "error",
-                "message": f"Error processing email: {str(e)}"
-            }
-        )
+    )
 
+@app.post(TELEGRAM_WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    """
+    Webhook endpoint for Telegram updates (webhook mode only)
+    
+    Requests must carry the configured secret in
+    X-Telegram-Bot-Api-Secret-Token. Updates are handed to the bot's
+    update queue, which runs Application.process_update, so Telegram
+    gets its answer without waiting for the handler.
+    """
+    if not TELEGRAM_WEBHOOK_URL or bot_app is None:
+        raise HTTPException(status_code=404, detail="Telegram webhook not enabled")
+    
+    token = request.headers.get("x-telegram-bot-api-secret-token", "")
+    if not hmac.compare_digest(token.encode(), TELEGRAM_WEBHOOK_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="Invalid secret token")
+    
+    try:
+        data = await request.json()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+    if not isinstance(data, dict) or "update_id" not in data:
+        raise HTTPException(status_code=400, detail="Invalid update")
+    
+    update = Update.de_json(data, bot_app.bot)
+    
+    await bot_app.update_queue.put(update)
+    return Response(status_code=200)
 
 
 if __name__ == "__main__":
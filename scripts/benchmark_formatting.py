@@ -0,0 +1,122 @@
+"""
+HTML Formatting Benchmark
+Measures the cost per KB of converting email HTML for Telegram,
+comparing the single-pass converter with the previous re.sub chain
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+# Add parent directory to path to import bot module
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from bot.formatting import html_to_telegram
+
+
+def legacy_cleanup(body_content: str) -> str:
+    """The sequential re.sub chain used before bot.formatting"""
+    body_content = re.sub(r'<script[^>]*>.*?</script>', '', body_content, flags=re.DOTALL | re.IGNORECASE)
+    body_content = re.sub(r'<style[^>]*>.*?</style>', '', body_content, flags=re.DOTALL | re.IGNORECASE)
+    body_content = re.sub(r'<h[1-6][^>]*>(.*?)</h[1-6]>', r'<b>\1</b>\n', body_content, flags=re.DOTALL)
+    body_content = re.sub(r'<strong[^>]*>(.*?)</strong>', r'<b>\1</b>', body_content, flags=re.DOTALL)
+    body_content = re.sub(r'<em[^>]*>(.*?)</em>', r'<i>\1</i>', body_content, flags=re.DOTALL)
+    body_content = re.sub(r'<(?!/?(?:b|i|u|s|code|pre|a)[>\s])[^>]+>', '', body_content)
+    body_content = re.sub(r'\n\s*\n', '\n\n', body_content)
+    return body_content.strip()
+
+
+# One block of typical newsletter markup (nested tables, inline styles, entities)
+NEWSLETTER_BLOCK = """
+<table role="presentation" width="100%" cellpadding="0" cellspacing="0" style="background:#ffffff">
+  <tr>
+    <td style="padding:24px;font-family:Arial,sans-serif">
+      <h2 style="margin:0;color:#333">Weekly update &mdash; issue {n}</h2>
+      <p style="font-size:14px;line-height:1.5">Hello there&nbsp;&amp; welcome back. Here is <strong>what's new</strong>
+      this week, including <em>several</em> improvements &lt;and&gt; fixes.</p>
+      <ul>
+        <li><a href="https://example.com/item/{n}?utm_source=mail&amp;utm_medium=email">Read the article</a></li>
+        <li>Second point with <b>bold</b> and <span style="color:red">styled</span> text</li>
+      </ul>
+      <div><img src="https://example.com/pixel.gif" width="1" height="1" alt=""></div>
+    </td>
+  </tr>
+</table>
+"""
+
+# Unclosed inline tags make the lazy DOTALL patterns scan to the end repeatedly
+UNCLOSED_BLOCK = "<p><strong>Offer {n}<em> ends soon<h3>Deal</p>\n"
+
+# A '<' that never closes must not make the tokenizer rescan the rest of the input
+STRAY_LT_BLOCK = "if a<b then "
+OPEN_TAG_BLOCK = "<b"
+
+STYLE = "<html><head><style>td { padding: 0 }</style></head><body>\n"
+
+
+def build_html(block: str, size_kb: int) -> str:
+    parts = [STYLE]
+    total = 0
+    n = 0
+    while total < size_kb * 1024:
+        chunk = block.format(n=n)
+        parts.append(chunk)
+        total += len(chunk)
+        n += 1
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def measure(func, html: str, repeat: int) -> float:
+    """Best wall time in seconds over repeat runs"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(html)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark email HTML conversion for Telegram")
+    parser.add_argument("--sizes", default="10,100,1000", help="Input sizes in KB (comma separated)")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per measurement (best is reported)")
+    parser.add_argument("--legacy-max-kb", type=int, default=200,
+                        help="Largest input given to the re.sub chain (it is quadratic on unclosed tags)")
+    args = parser.parse_args()
+    
+    sizes = [int(size) for size in args.sizes.split(",")]
+    cases = [
+        ("newsletter", NEWSLETTER_BLOCK),
+        ("unclosed tags", UNCLOSED_BLOCK),
+        ("stray <", STRAY_LT_BLOCK),
+        ("open tag <b", OPEN_TAG_BLOCK),
+    ]
+    
+    print("=" * 80)
+    print("⏱️  HTML FORMATTING BENCHMARK")
+    print("=" * 80)
+    print(f"{'input':<15} {'size':>8} {'single-pass':>16} {'re.sub chain':>16}")
+    
+    for name, block in cases:
+        for size_kb in sizes:
+            html = build_html(block, size_kb)
+            kb = len(html) / 1024
+            
+            new = measure(html_to_telegram, html, args.repeat)
+            row = f"{name:<15} {kb:>6.0f}KB {new * 1e6 / kb:>11.1f}µs/KB"
+            
+            if size_kb <= args.legacy_max_kb:
+                old = measure(legacy_cleanup, html, args.repeat)
+                row += f" {old * 1e6 / kb:>11.1f}µs/KB"
+            else:
+                row += f" {'skipped':>16}"
+            print(row)
+    
+    print("=" * 80)
+
+
+if __name__ == "__main__":
+    main()
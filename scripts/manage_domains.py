@@ -13,7 +13,7 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import AsyncSessionLocal, init_db, Domain
+from database import AsyncSessionLocal, init_db, Domain, notify_routing_change
 
 
 class DomainManager:
@@ -117,6 +117,7 @@ class DomainManager:
                 domain.expiry_date = None
         
         await self.session.commit()
+        notify_routing_change()
         print(f"\n✅ Domain '{domain.domain_name}' updated successfully!")
         return True
     
@@ -137,6 +138,7 @@ class DomainManager:
         domain_name = domain.domain_name
         await self.session.delete(domain)
         await self.session.commit()
+        notify_routing_change()
         
         print(f"\n✅ Domain '{domain_name}' deleted successfully!")
         return True
@@ -154,6 +156,7 @@ class DomainManager:
         
         domain.is_active = not domain.is_active
         await self.session.commit()
+        notify_routing_change()
         
         status = "activated" if domain.is_active else "deactivated"
         print(f"\n✅ Domain '{domain.domain_name}' {status}!")
@@ -0,0 +1,73 @@
+"""
+Shared test setup: a throwaway database and spool for the whole run
+
+The environment is set before any application module is imported, since
+config.py reads it at import time.
+"""
+
+import asyncio
+import itertools
+import os
+import tempfile
+
+import pytest
+
+_ROOT = tempfile.mkdtemp(prefix="email2telegram-tests-")
+os.environ.update({
+    "DATABASE_URL": f"sqlite+aiosqlite:///{_ROOT}/test.db",
+    "SPOOL_DIR": os.path.join(_ROOT, "spool"),
+    "BLOOM_FILE": os.path.join(_ROOT, "address_filter.bloom"),
+    "ROUTING_INVALIDATION_FILE": os.path.join(_ROOT, "routing_version"),
+    "TELEGRAM_BOT_TOKEN": "1:test",
+})
+
+_telegram_ids = itertools.count(1000)
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine on a fresh event loop, with the schema in place"""
+    from database import engine, init_db
+    
+    def runner(coro):
+        async def main():
+            try:
+                await init_db()
+                return await coro
+            finally:
+                # Pooled connections belong to this loop
+                await engine.dispose()
+        return asyncio.run(main())
+    
+    return runner
+
+
+@pytest.fixture
+def make_alias():
+    """Create a user with one alias on an active domain and return its Telegram ID"""
+    async def create(address: str) -> int:
+        from sqlalchemy import select
+        from database import AsyncSessionLocal, Domain, User, UserEmail
+        
+        domain_name = address.split("@", 1)[1]
+        telegram_id = next(_telegram_ids)
+        async with AsyncSessionLocal() as session:
+            domain = await session.scalar(select(Domain).where(Domain.domain_name == domain_name))
+            if domain is None:
+                domain = Domain(domain_name=domain_name, is_active=True)
+                session.add(domain)
+                await session.flush()
+            session.add(User(telegram_id=telegram_id, first_name="Test", credits=1))
+            session.add(UserEmail(user_id=telegram_id, email_address=address, domain_id=domain.id))
+            await session.commit()
+        return telegram_id
+    
+    return create
+
+
+def make_mail(message_id: str, to: str, subject: str = "Hello") -> bytes:
+    """Build a minimal raw MIME message"""
+    return (
+        f"From: sender@example.com\r\nTo: {to}\r\nMessage-ID: <{message_id}>\r\n"
+        f"Subject: {subject}\r\n\r\nBody of {subject}\r\n"
+    ).encode()
@@ -0,0 +1,38 @@
+"""
+Tests for ingest.batch (batch framing read straight from a file)
+"""
+
+import io
+
+import pytest
+
+from ingest.batch import decode_batch, encode_batch, iter_frames, write_frames
+
+
+def test_iter_frames_reads_only_the_head_of_each_message():
+    bodies = [b"a" * 10, b"", b"b" * 100000]
+    frames = list(iter_frames(io.BytesIO(encode_batch(bodies)), head_bytes=16))
+    
+    assert [length for _, length, _ in frames] == [10, 0, 100000]
+    assert [head for _, _, head in frames] == [b"a" * 10, b"", b"b" * 16]
+
+
+@pytest.mark.parametrize("data", [b"\x00\x00", b"\x00\x00\x00\x09short"])
+def test_iter_frames_rejects_truncated_batches(data):
+    with pytest.raises(ValueError):
+        list(iter_frames(io.BytesIO(data)))
+
+
+def test_iter_frames_enforces_max_messages():
+    with pytest.raises(ValueError):
+        list(iter_frames(io.BytesIO(encode_batch([b"x"] * 3)), max_messages=2))
+
+
+def test_write_frames_copies_selected_messages():
+    source = io.BytesIO(encode_batch([b"first", b"second", b"third"]))
+    frames = [(offset, length) for offset, length, _ in iter_frames(source)]
+    
+    dest = io.BytesIO()
+    write_frames(source, [frames[0], frames[2]], dest)
+    
+    assert decode_batch(dest.getvalue()) == [b"first", b"third"]
@@ -0,0 +1,81 @@
+"""
+Tests for the idempotency store as used by the ingest pipeline
+"""
+
+import asyncio
+
+from sqlalchemy import func, select
+
+from conftest import make_mail
+from database import AsyncSessionLocal, EmailLog, dedup_store
+from ingest import process_batch, process_email
+
+
+async def _log_count(receiver: str) -> int:
+    async with AsyncSessionLocal() as session:
+        return await session.scalar(
+            select(func.count(EmailLog.id)).where(EmailLog.receiver == receiver)
+        )
+
+
+def test_retried_delivery_is_dropped(run, make_alias):
+    async def scenario():
+        await make_alias("retry@dedup.test")
+        mail = make_mail("retry@x", "retry@dedup.test")
+        first = await process_email(mail)
+        second = await process_email(mail)
+        return first, second, await _log_count("retry@dedup.test")
+    
+    first, second, logs = run(scenario())
+    
+    assert first["status"] == "success"
+    assert second["status"] == "duplicate"
+    assert logs == 1
+
+
+def test_concurrent_duplicate_keeps_the_rest_of_the_batch(run, make_alias, monkeypatch):
+    async def scenario():
+        await make_alias("race@dedup.test")
+        await make_alias("race-other@dedup.test")
+        duplicate = make_mail("race@x", "race@dedup.test")
+        assert (await process_email(duplicate))["status"] == "success"
+        
+        # The batch passes the duplicate check before the first delivery
+        # commits, as a second worker racing the first one would
+        real_seen = dedup_store.seen
+        calls = []
+        
+        async def racing_seen(keys):
+            calls.append(keys)
+            return {} if len(calls) == 1 else await real_seen(keys)
+        
+        monkeypatch.setattr(dedup_store, "seen", racing_seen)
+        dedup_store._entries.clear()
+        
+        results = await process_batch([duplicate, make_mail("other@x", "race-other@dedup.test")])
+        return results, await _log_count("race@dedup.test"), await _log_count("race-other@dedup.test")
+    
+    results, duplicate_logs, other_logs = run(scenario())
+    
+    assert [result["status"] for result in results] == ["duplicate", "success"]
+    assert duplicate_logs == 1
+    assert other_logs == 1
+
+
+def test_resend_after_ttl_is_delivered_again(run, make_alias, monkeypatch):
+    monkeypatch.setattr(dedup_store, "ttl", 0.5)
+    
+    async def scenario():
+        await make_alias("resend@dedup.test")
+        mail = make_mail("resend@x", "resend@dedup.test")
+        first = await process_email(mail)
+        await asyncio.sleep(0.6)
+        # The expired key is still in the table: purge_expired only runs at startup
+        second = await process_email(mail)
+        third = await process_email(mail)
+        return first, second, third, await _log_count("resend@dedup.test")
+    
+    first, second, third, logs = run(scenario())
+    
+    assert [first["status"], second["status"], third["status"]] == ["success", "success", "duplicate"]
+    assert logs == 2
@@ -0,0 +1,115 @@
+"""
+Tests for bot.formatting (HTML conversion and message splitting)
+"""
+
+import time
+
+from bot.formatting import (
+    html_to_telegram, split_html, telegram_length, MESSAGE_LIMIT, TelegramHTMLConverter
+)
+
+NEWSLETTER_BLOCK = """
+<table role="presentation" width="100%" style="background:#ffffff">
+  <tr>
+    <td style="padding:24px">
+      <h2 style="margin:0">Weekly update &mdash; issue 1</h2>
+      <p>Hello there&nbsp;&amp; welcome back. Here is <strong>what's new</strong></p>
+      <ul><li><a href="https://example.com/item?a=1&amp;b=2">Read the article</a></li></ul>
+      <div><span style="color:red">styled</span> <img src="https://example.com/pixel.gif" alt=""></div>
+    </td>
+  </tr>
+</table>
+"""
+
+
+class _RecordingConverter(TelegramHTMLConverter):
+    """Records every handler call"""
+    
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+    
+    def handle_starttag(self, tag, attrs):
+        self.calls.append(tag)
+        super().handle_starttag(tag, attrs)
+    
+    def handle_endtag(self, tag):
+        self.calls.append('/' + tag)
+        super().handle_endtag(tag)
+    
+    def handle_data(self, data):
+        self.calls.append(data)
+        super().handle_data(data)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def test_stray_less_than_is_escaped_in_linear_time():
+    html, elapsed = _timed(html_to_telegram, "if a<b then " * 10000)
+    
+    assert html.startswith("if a&lt;b then if a&lt;b")
+    assert elapsed < 2
+
+
+def test_unclosed_open_tags_are_escaped_in_linear_time():
+    html, elapsed = _timed(html_to_telegram, "<b" * 40000)
+    
+    assert html == "&lt;b" * 40000
+    assert elapsed < 2
+
+
+def test_newsletter_markup_is_converted_in_linear_time():
+    html, elapsed = _timed(html_to_telegram, NEWSLETTER_BLOCK * 2000)
+    
+    assert html.startswith("<b>Weekly update \u2014 issue 1</b>\n\nHello there &amp; welcome back.")
+    assert elapsed < 2
+
+
+def test_indentation_and_unknown_tags_reach_no_handler():
+    converter = _RecordingConverter()
+    html = converter.convert(
+        '<table>\n  <tr>\n    <td><span style="x">Hello</span> <img src="a.gif"> world</td>\n  </tr>\n</table>'
+    )
+    
+    assert html == "Hello world"
+    assert converter.calls == ['table', 'tr', 'td', 'Hello', 'world', '/td', '/tr', '/table']
+
+
+def test_quoted_attribute_may_contain_angle_brackets():
+    html = html_to_telegram('<a href="https://example.com/?q=1" title="a>b">link</a>')
+    
+    assert html == '<a href="https://example.com/?q=1">link</a>'
+
+
+def test_skipped_element_without_end_tag_keeps_rest_of_document():
+    html = html_to_telegram("<b>one</b><style>p { color: red }<p>kept text</p>")
+    
+    assert "<b>one</b>" in html
+    assert "kept text" in html
+
+
+def test_skipped_element_content_is_dropped():
+    html = html_to_telegram("<head><style>td { padding: 0 }</style></head><p>Hello</p><script>x()</script>")
+    
+    assert html == "Hello"
+
+
+def test_split_long_run_without_breaks():
+    text = "字" * 1_000_000
+    chunks, elapsed = _timed(split_html, text)
+    
+    assert "".join(chunks) == text
+    assert all(telegram_length(chunk) <= MESSAGE_LIMIT for chunk in chunks)
+    assert elapsed < 2
+
+
+def test_split_reopens_formatting():
+    chunks = split_html("<b>" + "x" * 10000 + "</b> tail")
+    
+    assert all(chunk.startswith("<b>") for chunk in chunks)
+    assert all(telegram_length(chunk) <= MESSAGE_LIMIT for chunk in chunks)
+    assert chunks[-1].endswith("</b> tail")
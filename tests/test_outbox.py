@@ -0,0 +1,156 @@
+"""
+Tests for the notification outbox dispatcher
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, func, select
+from telegram.error import Forbidden, NetworkError
+
+from bot.delivery import delivery_scheduler
+from bot.outbox import OutboxDispatcher, enqueue_calls
+from database import AsyncSessionLocal, OutboxMessage, OutboxStatus
+
+_chat_ids = iter(range(5000, 6000))
+
+
+class FakeBot:
+    """Records send_message calls; the first one can be made slow"""
+    
+    def __init__(self, first_delay: float = 0):
+        self.first_delay = first_delay
+        self.sent = []
+    
+    async def send_message(self, chat_id, text, **params):
+        if not self.sent and self.first_delay:
+            self.sent.append(None)
+            await asyncio.sleep(self.first_delay)
+            self.sent[0] = (chat_id, text)
+        else:
+            self.sent.append((chat_id, text))
+
+
+def _message(text: str) -> dict:
+    return {"method": "send_message", "params": {"text": text}}
+
+
+async def _enqueue(chat_id: int, texts):
+    async with AsyncSessionLocal() as session:
+        # Rows left by other tests would be delivered first
+        await session.execute(delete(OutboxMessage))
+        await enqueue_calls(session, chat_id, [_message(text) for text in texts])
+        await session.commit()
+
+
+async def _pending_rows(chat_id: int) -> int:
+    async with AsyncSessionLocal() as session:
+        return await session.scalar(
+            select(func.count(OutboxMessage.id)).where(OutboxMessage.chat_id == chat_id)
+        )
+
+
+async def _deliver(dispatcher: OutboxDispatcher, bot: FakeBot, chat_id: int, timeout: float = 5):
+    """Run the dispatcher until the chat's rows are gone (or the timeout passes)"""
+    await dispatcher.start(SimpleNamespace(bot=bot))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        while await _pending_rows(chat_id) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+    finally:
+        await dispatcher.stop()
+        await delivery_scheduler.stop()
+
+
+@pytest.fixture
+def chat_id():
+    return next(_chat_ids)
+
+
+def test_rows_are_sent_once_in_order(run, chat_id):
+    bot = FakeBot()
+    dispatcher = OutboxDispatcher(poll_interval=0.05, worker_count=2)
+    
+    async def scenario():
+        await _enqueue(chat_id, ["one", "two", "three"])
+        await _deliver(dispatcher, bot, chat_id)
+        return await _pending_rows(chat_id)
+    
+    assert run(scenario()) == 0
+    assert bot.sent == [(chat_id, "one"), (chat_id, "two"), (chat_id, "three")]
+
+
+def test_slow_shard_outliving_its_lease_does_not_resend(run, chat_id):
+    # The first send takes several lease periods
+    bot = FakeBot(first_delay=1.0)
+    dispatcher = OutboxDispatcher(poll_interval=0.05, lease_seconds=0.3, worker_count=2)
+    
+    async def scenario():
+        await _enqueue(chat_id, ["one", "two", "three"])
+        await _deliver(dispatcher, bot, chat_id)
+    
+    run(scenario())
+    
+    assert bot.sent == [(chat_id, "one"), (chat_id, "two"), (chat_id, "three")]
+
+
+def test_stop_right_after_wake_returns(run):
+    async def scenario():
+        dispatcher = OutboxDispatcher(poll_interval=5)
+        await dispatcher.start(SimpleNamespace(bot=FakeBot()))
+        for _ in range(20):
+            await asyncio.sleep(0.01)
+            dispatcher.wake()
+            await asyncio.wait_for(dispatcher.stop(), timeout=2)
+            await dispatcher.start(SimpleNamespace(bot=FakeBot()))
+        await dispatcher.stop()
+    
+    run(scenario())
+
+
+def test_failed_send_is_retried_with_backoff(run, chat_id):
+    class FlakyBot(FakeBot):
+        async def send_message(self, chat_id, text, **params):
+            if text == "two" and not getattr(self, "failed", False):
+                self.failed = True
+                raise NetworkError("connection reset")
+            await super().send_message(chat_id, text, **params)
+    
+    bot = FlakyBot()
+    dispatcher = OutboxDispatcher(poll_interval=0.05, base_delay=0.05, max_delay=0.1)
+    
+    async def scenario():
+        await _enqueue(chat_id, ["one", "two", "three"])
+        await _deliver(dispatcher, bot, chat_id)
+        return await _pending_rows(chat_id)
+    
+    assert run(scenario()) == 0
+    assert bot.sent == [(chat_id, "one"), (chat_id, "two"), (chat_id, "three")]
+
+
+def test_permanent_error_marks_the_row_failed(run, chat_id):
+    class BlockedBot(FakeBot):
+        async def send_message(self, chat_id, text, **params):
+            raise Forbidden("bot was blocked by the user")
+    
+    dispatcher = OutboxDispatcher(poll_interval=0.05)
+    
+    async def scenario():
+        await _enqueue(chat_id, ["one"])
+        await dispatcher.start(SimpleNamespace(bot=BlockedBot()))
+        try:
+            for _ in range(100):
+                async with AsyncSessionLocal() as session:
+                    status = await session.scalar(
+                        select(OutboxMessage.status).where(OutboxMessage.chat_id == chat_id)
+                    )
+                if status != OutboxStatus.PENDING:
+                    return status
+                await asyncio.sleep(0.05)
+        finally:
+            await dispatcher.stop()
+            await delivery_scheduler.stop()
+    
+    assert run(scenario()) == OutboxStatus.FAILED
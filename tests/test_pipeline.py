@@ -0,0 +1,36 @@
+"""
+Tests for the ingest pipeline's notification queueing
+"""
+
+import json
+
+from sqlalchemy import select
+
+import bot.bot
+from bot.digest import EXPAND_PREFIX
+from conftest import make_mail
+from database import AsyncSessionLocal, EmailLog, OutboxMessage
+from ingest import process_email
+
+
+def test_summary_button_points_at_the_email_log(run, make_alias, monkeypatch):
+    monkeypatch.setattr(bot.bot, "LAZY_BODY_MODE", "always")
+    
+    async def scenario():
+        telegram_id = await make_alias("summary@pipeline.test")
+        result = await process_email(make_mail("summary@x", "summary@pipeline.test"))
+        async with AsyncSessionLocal() as session:
+            log_id = await session.scalar(
+                select(EmailLog.id).where(EmailLog.receiver == "summary@pipeline.test")
+            )
+            payloads = (await session.scalars(
+                select(OutboxMessage.payload).where(OutboxMessage.chat_id == telegram_id)
+            )).all()
+        return result, log_id, [json.loads(payload) for payload in payloads]
+    
+    result, log_id, calls = run(scenario())
+    
+    assert result["status"] == "success"
+    assert len(calls) == 1
+    button = calls[0]["params"]["reply_markup"]["inline_keyboard"][0][0]
+    assert button["callback_data"] == f"{EXPAND_PREFIX}{log_id}"
@@ -0,0 +1,86 @@
+"""
+Tests for the durable ingest spool and its workers
+"""
+
+import asyncio
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import ingest.pipeline
+from conftest import make_mail
+from ingest import EmailSpool, IngestWorkers
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return EmailSpool(str(tmp_path / "spool"))
+
+
+async def _drain(workers: IngestWorkers, spool: EmailSpool, timeout: float = 5):
+    """Wait until no item is pending (or the timeout passes)"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while spool.pending() and loop.time() < deadline:
+        await asyncio.sleep(0.02)
+    await workers.stop()
+
+
+def test_unfinished_items_are_replayed_on_start(run, make_alias, spool):
+    async def scenario():
+        await make_alias("replay@spool.test")
+        # Spooled by a previous run that stopped before processing it
+        spool.setup()
+        await spool.put(make_mail("replay@x", "replay@spool.test"))
+        
+        workers = IngestWorkers(spool, worker_count=1)
+        await workers.start()
+        await _drain(workers, spool)
+    
+    run(scenario())
+    
+    assert spool.pending() == []
+    assert list(spool.failed_dir.iterdir()) == []
+
+
+def test_transient_errors_are_retried(run, spool, monkeypatch):
+    attempts = []
+    
+    async def flaky_process_email(body, parser=None):
+        attempts.append(body)
+        if len(attempts) < 3:
+            raise OperationalError("INSERT", {}, Exception("database is locked"))
+        return {"status": "success"}
+    
+    monkeypatch.setattr(ingest.pipeline, "process_email", flaky_process_email)
+    
+    async def scenario():
+        workers = IngestWorkers(spool, worker_count=1, retry_base_delay=0.01, retry_max_delay=0.05)
+        await workers.start()
+        await workers.submit(b"raw email")
+        await _drain(workers, spool)
+    
+    run(scenario())
+    
+    assert len(attempts) == 3
+    assert spool.pending() == []
+    assert list(spool.failed_dir.iterdir()) == []
+
+
+def test_permanent_errors_move_the_item_to_failed(run, spool, monkeypatch):
+    async def broken_process_email(body, parser=None):
+        raise ValueError("unparseable")
+    
+    monkeypatch.setattr(ingest.pipeline, "process_email", broken_process_email)
+    
+    async def scenario():
+        workers = IngestWorkers(spool, worker_count=1, retry_base_delay=0.01)
+        await workers.start()
+        item_id = await workers.submit(b"raw email")
+        await _drain(workers, spool)
+        return item_id
+    
+    item_id = run(scenario())
+    
+    assert spool.pending() == []
+    assert [path.name for path in spool.failed_dir.iterdir()] == [item_id]